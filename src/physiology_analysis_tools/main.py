@@ -8,7 +8,7 @@ written by Christopher S Ward (C) 2024
 __version__ = "0.0.15"
 
 # try:
-from PySide6 import QtWidgets
+from PySide6 import QtWidgets, QtCore
 from PySide6.QtWidgets import QFileDialog, QMessageBox
 from PySide6.QtCore import Qt, QFile
 from PySide6.QtUiTools import QUiLoader
@@ -20,6 +20,8 @@ from PySide6.QtUiTools import QUiLoader
 import sys
 import os
 import importlib
+import multiprocessing
+import concurrent.futures
 
 # include regular and relative import -
 # !!! temporary solution - needed for pip distribution
@@ -31,6 +33,7 @@ try:
         "modules.arrhythmia_detection", "modules"
     )
     ml_tools = importlib.import_module("modules.ml_tools", "modules")
+    signal_quality = importlib.import_module("modules.signal_quality", "modules")
 except:
     print("use of relative import")
     heartbeat_detection = importlib.import_module(
@@ -45,6 +48,10 @@ except:
         "physiology_analysis_tools.modules.ml_tools",
         "physiology_analysis_tools.modules",
     )
+    signal_quality = importlib.import_module(
+        "physiology_analysis_tools.modules.signal_quality",
+        "physiology_analysis_tools.modules",
+    )
 
 
 import traceback
@@ -61,6 +68,7 @@ try:
         labchart_text_extract,
         pklgzip_extract,
         pcc_extract,
+        signal_filters_and_analyzers,
     )
 except:
     from .modules.signal_converters import (
@@ -69,6 +77,7 @@ except:
         labchart_text_extract,
         pklgzip_extract,
         pcc_extract,
+        signal_filters_and_analyzers,
     )
 
 extractors = {
@@ -100,6 +109,103 @@ def gather_data(
     return list(x_val), list(y_val)
 
 
+class FilteredSignals(QtCore.QObject):
+    """
+    Filtered view of the signal columns of a DataFrame, filled on first use.
+    Columns are filtered with heartbeat_detection.basic_filter on a thread
+    pool (scipy releases the GIL while filtering) and only when they are
+    requested or prefetched, so channels that are never plotted or analysed
+    are never filtered. Time and non-numeric (e.g. comment) columns are
+    passed through unfiltered.
+
+    Supports the column access used by gather_data and call_arrhythmias,
+    e.g. filtered_signals["ecg"], which waits for the column to be filtered.
+    The GUI thread should check is_ready() instead and redraw on
+    column_ready, which is emitted as each column is finished.
+    """
+
+    # emitted from the worker thread, queued by Qt to the GUI thread
+    column_ready = QtCore.Signal(str)
+
+    def __init__(self, executor, known_time_columns):
+        super().__init__()
+        self.executor = executor
+        self.known_time_columns = known_time_columns
+        self.data = None
+        self.futures = {}
+
+    def update(self, data, time_column, order, cutoff):
+        """
+        Set the source data and filter settings. Pending jobs for the
+        previous settings are cancelled and their results discarded.
+        """
+        self.cancel()
+        self.data = data
+        self.order = order
+        self.cutoff = cutoff
+        self.sampling_frequency = 1 / (data[time_column][1] - data[time_column][0])
+
+    def cancel(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = {}
+
+    def needs_filter(self, column):
+        return column not in self.known_time_columns and pandas.api.types.is_numeric_dtype(
+            self.data[column]
+        )
+
+    def filter_column(self, column):
+        return heartbeat_detection.basic_filter(
+            self.order,
+            self.data[column],
+            fs=self.sampling_frequency,
+            cutoff=self.cutoff,
+            output="sos",
+        )
+
+    def prefetch(self, column):
+        """
+        Start filtering a column in the background if it is not already
+        filtered or queued.
+        """
+        if column in self.data.columns and self.needs_filter(column):
+            if column not in self.futures:
+                future = self.executor.submit(self.filter_column, column)
+                self.futures[column] = future
+                future.add_done_callback(
+                    lambda future, column=column: self.announce(future, column)
+                )
+
+    def announce(self, future, column):
+        # results for cancelled jobs or replaced settings are not announced
+        if not future.cancelled() and self.futures.get(column) is future:
+            self.column_ready.emit(column)
+
+    def is_ready(self, column):
+        """
+        True if column can be read without waiting, otherwise start
+        filtering it (column_ready is emitted when it is done).
+        """
+        if not self.needs_filter(column):
+            return True
+        self.prefetch(column)
+        return self.futures[column].done()
+
+    def __getitem__(self, column):
+        if not self.needs_filter(column):
+            return self.data[column]
+        self.prefetch(column)
+        return self.futures[column].result()
+
+    def __contains__(self, column):
+        return column in self.data.columns
+
+    @property
+    def columns(self):
+        return self.data.columns
+
+
 # %% setup the main window
 class MainWindow(QtWidgets.QMainWindow):
     def __init__(self, ui, *args, **kwargs):
@@ -138,6 +244,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.current_beat = None
         self.current_beat_index = 0
         self.quality_score_markers = None
+        self.quality_df = None
+        self.low_quality_list = []
         self.bad_data_markers = None
         self.bad_data_mode = False
         self.plotted = {}
@@ -147,8 +255,19 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.known_time_columns = ["ts", "time"]
 
-        self.beat_settings = heartbeat_detection.Settings()
+        self.filter_executor = concurrent.futures.ThreadPoolExecutor()
+        self.filtered_data = FilteredSignals(
+            self.filter_executor, self.known_time_columns
+        )
+        self.filtered_data.column_ready.connect(self.action_filtered_column_ready)
+
+        self.beat_settings_dict = {
+            k: v["settings"]() for k, v in heartbeat_detection.beat_detectors.items()
+        }
+        self.beat_settings = self.beat_settings_dict["threshold"]
         self.arrhythmia_settings = arrhythmia_detection.Settings()
+        self.import_settings = signal_filters_and_analyzers.ResampleSettings()
+        self.quality_settings = signal_quality.Settings()
 
         self.known_time_columns = ["ts", "time"]
 
@@ -165,6 +284,10 @@ class MainWindow(QtWidgets.QMainWindow):
         self.actionOpen_Files.triggered.connect(self.action_Add_Files)
         self.actionExit.triggered.connect(QtWidgets.QApplication.instance().quit)
         self.actionBeat_Detection.triggered.connect(self.action_BeatDetection)
+        self.actionParameter_Sweep.triggered.connect(self.action_Parameter_Sweep)
+        self.actionRedetect_Beats_In_View.triggered.connect(
+            self.action_Redetect_Beats_In_View
+        )
         self.actionArrhythmia_Analysis.triggered.connect(
             self.action_Arrhythmia_Analysis
         )
@@ -220,6 +343,11 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.action_set_arr_method()
 
+        self.comboBox_beat_engine.currentTextChanged.connect(
+            self.action_update_beat_engine
+        )
+        self.action_set_beat_engine()
+
         self.comboBox_arrhyth_assign.addItems(
             arrhythmia_detection.annot_arrhythmia_categories
         )
@@ -295,6 +423,10 @@ class MainWindow(QtWidgets.QMainWindow):
             self.graph.removeItem(self.bad_data_markers)
         self.bad_data_markers = None
 
+        if self.quality_score_markers is not None:
+            self.graph.removeItem(self.quality_score_markers)
+        self.quality_score_markers = None
+
     def assign_arrhyth_category(self):
         self.beat_df.at[
             self.current_beat_index, self.comboBox_arrhyth_assign.currentText()
@@ -323,10 +455,9 @@ class MainWindow(QtWidgets.QMainWindow):
             symbol_size=12,
         )
 
-        self.current_arrhythmia_index = self.arrhythmia_only_df[
-            self.arrhythmia_only_df["ts"]
-            == self.beat_df.iloc[self.current_beat_index]["ts"]
-        ].index[0]
+        self.current_arrhythmia_index = self.arrhythmia_only_df["index"].searchsorted(
+            self.current_beat_index
+        )
 
         self.update_graph()
 
@@ -340,9 +471,10 @@ class MainWindow(QtWidgets.QMainWindow):
             if self.clicked_coordinates.x() < self.beat_df.iloc[0]["ts"]:
                 return
             # get index of selected beat
-            self.current_beat_index = self.beat_df[
-                self.beat_df["ts"] >= self.clicked_coordinates.x()
-            ].index[0]
+            self.current_beat_index = min(
+                self.beat_df["ts"].searchsorted(self.clicked_coordinates.x()),
+                self.beat_df.shape[0] - 1,
+            )
             # print(self.beat_df[self.beat_df['ts']>=self.clicked_coordinates.x()]['ts'])
             # print(self.current_beat_index)
             # print(self.beat_df.iloc[self.current_beat_index])
@@ -411,9 +543,8 @@ class MainWindow(QtWidgets.QMainWindow):
 
         if self.beat_df.iloc[self.current_beat_index]["annot_any_arrhythmia"] > 0:
             self.current_arrhythmia_index = self.arrhythmia_only_df[
-                self.arrhythmia_only_df["ts"]
-                == self.beat_df.iloc[self.current_beat_index]["ts"]
-            ].index[0]
+                "index"
+            ].searchsorted(self.current_beat_index)
             self.current_arrhythmia = self.graph.plot(
                 x=[self.beat_df.iloc[self.current_beat_index]["ts"]],
                 y=[1.2],
@@ -536,6 +667,11 @@ class MainWindow(QtWidgets.QMainWindow):
         for k, v in self.plotted.items():
             if self.checkBox_plot_filtered.isChecked():
                 source = v["filt_source"]
+                # columns still being filtered are drawn once they are ready
+                if isinstance(source, FilteredSignals) and not source.is_ready(
+                    v["name"]
+                ):
+                    continue
             else:
                 source = v["source"]
 
@@ -633,6 +769,11 @@ class MainWindow(QtWidgets.QMainWindow):
                 except:
                     print("unable to open - trying another extractor")
 
+        if self.data is not None and self.import_settings.resample_rate:
+            self.data = signal_filters_and_analyzers.resample_signals(
+                self.data, self.import_settings.resample_rate
+            )
+
         if self.data is not None:
             # print('data opened')
             self.action_update_available_signals()
@@ -645,28 +786,25 @@ class MainWindow(QtWidgets.QMainWindow):
         self.bad_beat_only_df = None
         self.arrhythmia_only_df = None
         self.bad_data_list = []
+        self.quality_df = None
+        self.low_quality_list = []
 
-    def action_update_filtered_signals(self):
-
-        # !!! need to update logic flow for this
-        self.filtered_data = pandas.DataFrame()
+    def action_filtered_column_ready(self, column):
+        if self.checkBox_plot_filtered.isChecked() and any(
+            v["name"] == column for v in self.plotted.values()
+        ):
+            self.update_graph()
 
-        sampling_frequency = 1 / (
-            self.data[self.comboBox_time_column.currentText()][1]
-            - self.data[self.comboBox_time_column.currentText()][0]
+    def action_update_filtered_signals(self):
+        # columns are filtered on first use, starting with the selected signal
+        self.filtered_data.update(
+            self.data,
+            self.comboBox_time_column.currentText(),
+            self.doubleSpinBox_filt_order.value(),
+            self.doubleSpinBox_filt_freq.value(),
         )
-
-        for c in self.data.columns:
-            if c in self.known_time_columns:
-                self.filtered_data[c] = self.data[c]
-            else:
-                self.filtered_data[c] = heartbeat_detection.basic_filter(
-                    self.doubleSpinBox_filt_order.value(),
-                    self.data[c],
-                    fs=sampling_frequency,
-                    cutoff=self.doubleSpinBox_filt_freq.value(),
-                    output="sos",
-                )
+        if self.listWidget_Signals.currentItem() is not None:
+            self.filtered_data.prefetch(self.listWidget_Signals.currentItem().text())
 
     def action_update_available_signals(self):
         self.listWidget_Signals.clear()
@@ -707,6 +845,15 @@ class MainWindow(QtWidgets.QMainWindow):
         self.comboBox_arr_method.clear()
         self.comboBox_arr_method.addItems(["Heuristics", "Unsupervised", "Both"])
 
+    def action_set_beat_engine(self):
+        self.comboBox_beat_engine.clear()
+        self.comboBox_beat_engine.addItems(heartbeat_detection.beat_detectors)
+
+    def action_update_beat_engine(self):
+        engine = self.comboBox_beat_engine.currentText()
+        if engine in self.beat_settings_dict:
+            self.beat_settings = self.beat_settings_dict[engine]
+
     def action_start_of_file(self):
         self.doubleSpinBox_x_min.setValue(self.start_of_file)
         self.update_graph()
@@ -759,6 +906,24 @@ class MainWindow(QtWidgets.QMainWindow):
     #         self.graph.removeItem(self.arrhythmia_markers)
     #     self.arrhythmia_markers = None
 
+    def get_included_intervals(self):
+        """
+        Time intervals outside the marked bad data blocks (and the windows
+        failing quality scoring, when skip_low_quality is set), or None if
+        there is nothing to exclude, so that detection and arrhythmia calls
+        skip the bad data.
+        """
+        excluded = list(self.bad_data_list)
+        if self.quality_settings.skip_low_quality:
+            excluded += self.low_quality_list
+        if excluded == []:
+            return None
+
+        time = self.data[self.comboBox_time_column.currentText()]
+        return heartbeat_detection.complement_intervals(
+            excluded, time.iloc[0], time.iloc[-1] + (time.iloc[1] - time.iloc[0])
+        )
+
     def action_BeatDetection(self):
         if self.DEVMODE:
             try:
@@ -776,12 +941,14 @@ class MainWindow(QtWidgets.QMainWindow):
 
         print(f"searching for beats in {self.voltage_column} by self.time_column")
 
-        self.beat_df = heartbeat_detection.beatcaller(
+        self.beat_df = heartbeat_detection.detect_beats(
             self.data,
             time_column=self.comboBox_time_column.currentText(),
             voltage_column=self.listWidget_Signals.currentItem().text(),
-            **self.beat_settings.__dict__,
-        ).reset_index(drop=True)
+            engine=self.comboBox_beat_engine.currentText(),
+            settings=self.beat_settings,
+            intervals=self.get_included_intervals(),
+        ).to_frame().reset_index()
 
         self.beat_markers = self.add_plot(
             source=self.beat_df,
@@ -801,8 +968,123 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # !!! need to add integration for center/filetype configs
 
+    def action_Redetect_Beats_In_View(self):
+        if self.beat_df is None:
+            print("no beat info - run beat detection on the whole file first")
+            return
+        if self.DEVMODE:
+            try:
+                importlib.reload(heartbeat_detection)
+            except:
+                importlib.reload(heartbeat_detection)
+
+        start = self.doubleSpinBox_x_min.value()
+        stop = start + self.doubleSpinBox_x_window.value()
+
+        print(f"re-detecting beats between {start} and {stop}")
+
+        beat_table = heartbeat_detection.detect_beats_in_range(
+            self.data,
+            start,
+            stop,
+            time_column=self.comboBox_time_column.currentText(),
+            voltage_column=self.listWidget_Signals.currentItem().text(),
+            engine=self.comboBox_beat_engine.currentText(),
+            settings=self.beat_settings,
+        )
+        self.beat_df = heartbeat_detection.splice_beats(
+            self.beat_df, beat_table, start, stop
+        )
+        self.current_beat_index = min(
+            self.current_beat_index, self.beat_df.shape[0] - 1
+        )
+
+        if self.beat_markers is not None:
+            self.graph.removeItem(self.beat_markers)
+        self.beat_markers = self.add_plot(
+            source=self.beat_df,
+            filt_source=self.beat_df,
+            time_column="ts",
+            signal_column="beats",
+            symbol="o",
+            symbol_pen=(0, 0, 0),
+            symbol_brush=(0, 255, 0),
+            symbol_size=8,
+        )
+
+        if "any_arrhythmia" in self.beat_df.columns:
+            self.arrhythmia_only_df = self.beat_df[
+                self.beat_df.any_arrhythmia
+            ].reset_index()
+            self.current_arrhythmia_index = min(
+                self.current_arrhythmia_index,
+                max(self.arrhythmia_only_df.shape[0] - 1, 0),
+            )
+            if self.arrhythmia_markers is not None:
+                self.graph.removeItem(self.arrhythmia_markers)
+            self.arrhythmia_markers = self.add_plot(
+                source=self.arrhythmia_only_df,
+                filt_source=self.arrhythmia_only_df,
+                time_column="ts",
+                signal_column="annot_any_arrhythmia",
+                symbol="t1",
+                symbol_pen=(0, 0, 0),
+                symbol_brush=(255, 0, 0),
+                symbol_size=12,
+            )
+
+        if self.bad_data_list != []:
+            if self.bad_data_markers is not None:
+                self.graph.removeItem(self.bad_data_markers)
+            self.action_update_bad_data_marks()
+
+        self.update_graph()
+
     def action_Quality_Scoring(self):
-        print("quality scoring not yet implemented")
+        if self.DEVMODE:
+            try:
+                importlib.reload(signal_quality)
+            except:
+                importlib.reload(signal_quality)
+
+        if self.quality_score_markers is not None:
+            self.graph.removeItem(self.quality_score_markers)
+        self.quality_score_markers = None
+
+        print(f"scoring signal quality of {self.listWidget_Signals.currentItem().text()}")
+
+        self.quality_df = signal_quality.signal_quality(
+            self.data,
+            voltage_column=self.listWidget_Signals.currentItem().text(),
+            time_column=self.comboBox_time_column.currentText(),
+            settings=self.quality_settings,
+            beat_settings=self.beat_settings_dict,
+        )
+        self.low_quality_list = signal_quality.low_quality_intervals(
+            self.quality_df, self.quality_settings.window_duration
+        )
+
+        print(
+            f"{(~self.quality_df['acceptable']).sum()} of {self.quality_df.shape[0]} "
+            "windows below quality limits, "
+            + (
+                "excluded from beat and arrhythmia detection"
+                if self.quality_settings.skip_low_quality
+                else "not excluded (skip_low_quality is off)"
+            )
+        )
+
+        self.quality_score_markers = self.add_plot(
+            pen=pyqtgraph.mkPen((200, 100, 0), width=1),
+            source=self.quality_df.reset_index(),
+            filt_source=self.quality_df.reset_index(),
+            time_column="window_start",
+            signal_column="quality_score",
+            symbol="s",
+            symbol_pen=(200, 100, 0),
+            symbol_brush=(200, 100, 0),
+            symbol_size=6,
+        )
 
     def action_Arrhythmia_Analysis(self):
         if self.DEVMODE:
@@ -829,6 +1111,7 @@ class MainWindow(QtWidgets.QMainWindow):
             selected_signal=self.listWidget_Signals.currentItem().text(),
             selected_time=self.comboBox_time_column.currentText(),
             arr_methods=self.comboBox_arr_method.currentText(),
+            intervals=self.get_included_intervals(),
         )
 
         self.arrhythmia_only_df = self.beat_df[
@@ -875,37 +1158,23 @@ class MainWindow(QtWidgets.QMainWindow):
         self.action_update_current_arrhythmia()
 
     def action_confirm_arrhythmia(self):
-        self.beat_df.loc[
-            (
-                self.beat_df["ts"]
-                == self.arrhythmia_only_df.iloc[self.current_arrhythmia_index]["ts"]
-            ),
+        self.beat_df.at[
+            self.arrhythmia_only_df.at[self.current_arrhythmia_index, "index"],
             "annot_any_arrhythmia",
         ] = 2
-        self.arrhythmia_only_df.loc[
-            (
-                self.arrhythmia_only_df["ts"]
-                == self.arrhythmia_only_df.iloc[self.current_arrhythmia_index]["ts"]
-            ),
-            "annot_any_arrhythmia",
+        self.arrhythmia_only_df.at[
+            self.current_arrhythmia_index, "annot_any_arrhythmia"
         ] = 2
 
         self.action_next_arrhythmia()
 
     def action_reject_arrhythmia(self):
-        self.beat_df.loc[
-            (
-                self.beat_df["ts"]
-                == self.arrhythmia_only_df.iloc[self.current_arrhythmia_index]["ts"]
-            ),
+        self.beat_df.at[
+            self.arrhythmia_only_df.at[self.current_arrhythmia_index, "index"],
             "annot_any_arrhythmia",
         ] = -1
-        self.arrhythmia_only_df.loc[
-            (
-                self.arrhythmia_only_df["ts"]
-                == self.arrhythmia_only_df.iloc[self.current_arrhythmia_index]["ts"]
-            ),
-            "annot_any_arrhythmia",
+        self.arrhythmia_only_df.at[
+            self.current_arrhythmia_index, "annot_any_arrhythmia"
         ] = -1
 
         self.action_next_arrhythmia()
@@ -947,10 +1216,9 @@ class MainWindow(QtWidgets.QMainWindow):
             - self.doubleSpinBox_x_window.value() / 3
         )
 
-        self.current_beat_index = self.beat_df[
-            self.beat_df["ts"]
-            == self.arrhythmia_only_df.iloc[self.current_arrhythmia_index]["ts"]
-        ].index[0]
+        self.current_beat_index = self.arrhythmia_only_df.at[
+            self.current_arrhythmia_index, "index"
+        ]
 
         self.categorize_beat_arrhythmias()
 
@@ -984,6 +1252,8 @@ class MainWindow(QtWidgets.QMainWindow):
         writer = pandas.ExcelWriter(output_path, engine="xlsxwriter")
         self.beat_df.to_excel(writer, sheet_name="beats", index=False)
         bad_data_df.to_excel(writer, sheet_name="bad_data_marks", index=False)
+        if self.quality_df is not None:
+            self.quality_df.to_excel(writer, sheet_name="quality_scores")
         writer.close()
         print("finished")
 
@@ -991,6 +1261,16 @@ class MainWindow(QtWidgets.QMainWindow):
         window = SettingsWindow(parent=self)
         window.exec()
 
+    def action_Parameter_Sweep(self):
+        if self.DEVMODE:
+            try:
+                importlib.reload(heartbeat_detection)
+            except:
+                importlib.reload(heartbeat_detection)
+
+        window = SweepWindow(parent=self)
+        window.exec()
+
 
 class SettingsWindow(QtWidgets.QDialog):
     def __init__(self, parent=None):
@@ -1009,7 +1289,9 @@ class SettingsWindow(QtWidgets.QDialog):
         beat_options = {}
 
         for k, v in beat_settings.__dict__.items():
-            EntryWidget = FlexibleEntryWidget(value=v)
+            EntryWidget = FlexibleEntryWidget(
+                value=v, choices=heartbeat_detection.setting_choices.get(k)
+            )
             beat_options[k] = EntryWidget
             beat_layout.addRow(k, EntryWidget.entry)
 
@@ -1027,11 +1309,39 @@ class SettingsWindow(QtWidgets.QDialog):
             arr_options[k] = EntryWidget
             arr_layout.addRow(k, EntryWidget.entry)
 
+        # Create layout for import settings (applied to the next file opened)
+
+        import_layout = QtWidgets.QFormLayout()
+
+        import_options = {}
+
+        for k, v in parent.import_settings.__dict__.items():
+
+            EntryWidget = FlexibleEntryWidget(value=v)
+            import_options[k] = EntryWidget
+            import_layout.addRow(k, EntryWidget.entry)
+
+        # Create layout for quality scoring
+
+        quality_layout = QtWidgets.QFormLayout()
+
+        quality_options = {}
+
+        for k, v in parent.quality_settings.__dict__.items():
+
+            EntryWidget = FlexibleEntryWidget(value=v)
+            quality_options[k] = EntryWidget
+            quality_layout.addRow(k, EntryWidget.entry)
+
         self.beatSettingsOptions = beat_options
         self.arrSettingsOptions = arr_options
+        self.importSettingsOptions = import_options
+        self.qualitySettingsOptions = quality_options
 
         inner_layout.addLayout(beat_layout)
         inner_layout.addLayout(arr_layout)
+        inner_layout.addLayout(import_layout)
+        inner_layout.addLayout(quality_layout)
 
         self.button = QtWidgets.QPushButton("Update Settings")
         self.button.clicked.connect(self.updateSettings)
@@ -1048,20 +1358,141 @@ class SettingsWindow(QtWidgets.QDialog):
         for k, v in self.arrSettingsOptions.items():
             self.parentFrame.arrhythmia_settings.__dict__[k] = v.getValues()
 
+        for k, v in self.importSettingsOptions.items():
+            self.parentFrame.import_settings.__dict__[k] = v.getValues()
+
+        for k, v in self.qualitySettingsOptions.items():
+            self.parentFrame.quality_settings.__dict__[k] = v.getValues()
+
         self.close()
 
 
+class SweepWindow(QtWidgets.QDialog):
+    """
+    Dialog for running heartbeat_detection.beatcaller_sweep() on the selected
+    signal. Each beat detection setting accepts a comma separated list of
+    values to test, and the results are shown in a table.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.parentFrame = parent
+        self.setWindowTitle("ECG Analysis - Parameter Sweep")
+
+        outer_layout = QtWidgets.QVBoxLayout()
+        sweep_layout = QtWidgets.QFormLayout()
+
+        self.sweep_settings = parent.beat_settings_dict["threshold"]
+        self.sweepOptions = {}
+
+        for k, v in self.sweep_settings.__dict__.items():
+            entry = QtWidgets.QLineEdit()
+            entry.setText(str(v))
+            if k in heartbeat_detection.setting_choices:
+                entry.setToolTip(
+                    "one or more of "
+                    + ", ".join(str(c) for c in heartbeat_detection.setting_choices[k])
+                )
+            self.sweepOptions[k] = entry
+            sweep_layout.addRow(k, entry)
+
+        self.button = QtWidgets.QPushButton("Run Sweep")
+        self.button.clicked.connect(self.runSweep)
+
+        self.table = QtWidgets.QTableWidget()
+
+        outer_layout.addLayout(sweep_layout)
+        outer_layout.addWidget(self.button)
+        outer_layout.addWidget(self.table)
+        self.setLayout(outer_layout)
+
+    def parseValues(self, text, current_value, choices=None):
+        values = []
+        for i in text.split(","):
+            i = i.strip()
+            if i == "" or i == "None":
+                values.append(None)
+            elif choices is not None:
+                # e.g. ecg_invert, which is False, True or "auto"
+                lookup = {str(c).lower(): c for c in choices}
+                if i.lower() not in lookup:
+                    raise ValueError(f"{i} is not one of {choices}")
+                values.append(lookup[i.lower()])
+            elif type(current_value) == bool:
+                values.append(i.lower() in ["true", "1", "yes"])
+            elif type(current_value) == str:
+                values.append(i)
+            else:
+                # settings with an int default keep int values, but a
+                # fractional value (e.g. a perc_thresh of 96.5) is kept
+                value = float(i)
+                if type(current_value) == int and value.is_integer():
+                    value = int(value)
+                values.append(value)
+
+        return values
+
+    def runSweep(self):
+        settings_grid = {}
+        for k, v in self.sweepOptions.items():
+            try:
+                values = self.parseValues(
+                    v.text(),
+                    self.sweep_settings.__dict__[k],
+                    heartbeat_detection.setting_choices.get(k),
+                )
+            except ValueError:
+                QMessageBox.warning(
+                    self,
+                    "Parameter Sweep",
+                    f"could not read the values for {k}: {v.text()}",
+                )
+                return
+            if values != [self.sweep_settings.__dict__[k]]:
+                settings_grid[k] = values
+
+        if not settings_grid:
+            print("no settings to sweep - enter comma separated values")
+            return
+
+        sweep_df = heartbeat_detection.beatcaller_sweep(
+            self.parentFrame.data,
+            settings_grid,
+            voltage_column=self.parentFrame.listWidget_Signals.currentItem().text(),
+            time_column=self.parentFrame.comboBox_time_column.currentText(),
+            settings=self.sweep_settings,
+        )
+        print(sweep_df)
+
+        self.table.clear()
+        self.table.setRowCount(sweep_df.shape[0])
+        self.table.setColumnCount(sweep_df.shape[1])
+        self.table.setHorizontalHeaderLabels([str(c) for c in sweep_df.columns])
+        for r in range(sweep_df.shape[0]):
+            for c in range(sweep_df.shape[1]):
+                self.table.setItem(
+                    r, c, QtWidgets.QTableWidgetItem(str(sweep_df.iat[r, c]))
+                )
+
+
 class FlexibleEntryWidget:
     """
     Class to allow for a flexible 'data entry' widget that will adjust the type depending on the input data type
     This allows for easier building of layouts where the form and format of the input is not known/will change
+    A list of choices gives a drop-down list of those values instead
     """
 
-    def __init__(self, value):
+    def __init__(self, value, choices=None):
 
         self.type = type(value)
+        self.choices = choices
+
+        if choices is not None:
+            self.entry = QtWidgets.QComboBox()
+            self.entry.addItems([str(c) for c in choices])
+            self.entry.setCurrentText(str(value))
 
-        if self.type == type(None):
+        elif self.type == type(None):
             self.entry = QtWidgets.QLineEdit()
 
         elif self.type == bool:
@@ -1074,7 +1505,10 @@ class FlexibleEntryWidget:
 
     def getValues(self):
 
-        if self.type in [float, int]:
+        if self.choices is not None:
+            return self.choices[self.entry.currentIndex()]
+
+        elif self.type in [float, int]:
             value = self.entry.text()
             if value == "":
                 return None
@@ -1090,6 +1524,9 @@ class FlexibleEntryWidget:
             value = self.entry.isChecked()
             return value
 
+        elif self.type == str:
+            return self.entry.text()
+
         else:
             value = self.entry.text()
 
@@ -1103,6 +1540,9 @@ class FlexibleEntryWidget:
 
 def main():
 
+    # needed for the process pool used by the parameter sweep in packaged builds
+    multiprocessing.freeze_support()
+
     loader = QUiLoader()
     print("1")
     app = QtWidgets.QApplication(sys.argv)
@@ -15,6 +15,10 @@ try:
     from modules import ml_tools
 except:
     from physiology_analysis_tools.modules import ml_tools
+try:
+    from modules import heartbeat_detection
+except:
+    from physiology_analysis_tools.modules import heartbeat_detection
 
 # %% define functions
 
@@ -125,11 +129,34 @@ def call_premature_beat_multiple(df, rr_column_name, ts_column_name, threshold):
 
 
 def call_arrhythmias(
-    df, settings, signals=None, selected_signal=None, selected_time = None, arr_methods=None
+    df,
+    settings,
+    signals=None,
+    selected_signal=None,
+    selected_time=None,
+    arr_methods=None,
+    intervals=None,
 ):
+    """
+    Call arrhythmias on a beat DataFrame with the selected methods.
+
+    intervals - list of [start, stop] - if provided, only beats with ts inside
+        these time ranges are analysed. The other beats are marked True in an
+        "excluded" column and are not called as arrhythmias.
+        (heartbeat_detection.complement_intervals() converts a list of bad
+        data blocks into this form)
+    """
     if arr_methods == "Both":
         arr_methods = ["Heuristic", "Unsupervised"]
 
+    if intervals is not None:
+        included = heartbeat_detection.in_intervals(df["ts"], intervals)
+        df["excluded"] = ~included
+        analysis_df = df[included].reset_index(drop=True)
+    else:
+        included = None
+        analysis_df = df
+
     arrhythmia_categories = []
 
     if "Heuristic" in arr_methods:
@@ -140,17 +167,17 @@ def call_arrhythmias(
             "prem_beat",
         ]
         # call heuristic arrhythmias
-        df["bradycardia_absolute"] = call_bradycardia_absolute(
-            df, "RR", 60 / settings.bradycardia_absolute_hr
+        analysis_df["bradycardia_absolute"] = call_bradycardia_absolute(
+            analysis_df, "RR", 60 / settings.bradycardia_absolute_hr
         )
-        df["tachycardia_absolute"] = call_tachycardia_absolute(
-            df, "RR", 60 / settings.tachycardia_absolute_hr
+        analysis_df["tachycardia_absolute"] = call_tachycardia_absolute(
+            analysis_df, "RR", 60 / settings.tachycardia_absolute_hr
         )
-        df["skipped_beat"] = call_skipped_beat_multiple(
-            df, "RR", "ts", settings.skipped_beat_multiple_rr
+        analysis_df["skipped_beat"] = call_skipped_beat_multiple(
+            analysis_df, "RR", "ts", settings.skipped_beat_multiple_rr
         )
-        df["prem_beat"] = call_premature_beat_multiple(
-            df, "RR", "ts", settings.premature_beat_multiple_rr
+        analysis_df["prem_beat"] = call_premature_beat_multiple(
+            analysis_df, "RR", "ts", settings.premature_beat_multiple_rr
         )
 
     if "Unsupervised" in arr_methods:
@@ -165,10 +192,19 @@ def call_arrhythmias(
                 "signal information not adequately provided to signals and selected_signal arguments of call_arrhythmias()"
             )
 
-        df["abn_cluster"]= ml_tools.call_arrhythmias_PCA(
-            signals, df, selected_signal, selected_time, settings
+        analysis_df["abn_cluster"]= ml_tools.call_arrhythmias_PCA(
+            signals, analysis_df, selected_signal, selected_time, settings
         )["abn_cluster"]
 
+    # excluded beats are not called as arrhythmias
+    if included is not None:
+        for a in arrhythmia_categories:
+            df[a] = (
+                analysis_df[a]
+                .set_axis(df.index[included])
+                .reindex(df.index, fill_value=False)
+            )
+
     df["any_arrhythmia"] = df[arrhythmia_categories].any(axis=1, bool_only=True)
 
     df["other_arrhythmia"] = False
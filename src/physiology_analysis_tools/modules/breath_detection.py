@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""
+breath_detection for ECG Analysis Tool
+
+Breath segmentation for plethysmography and pneumotachography flow signals.
+Inspiration and expiration onsets are the zero crossings of the smoothed
+flow, confirmed by hysteresis so noise around zero flow does not split a
+breath, and every per-breath measure is taken with array operations.
+"""
+
+__version__ = "0.0.1"
+
+# %% import libraries
+import numpy
+import pandas
+
+try:
+    from modules.signal_converters import signal_filters_and_analyzers
+except:
+    from physiology_analysis_tools.modules.signal_converters import (
+        signal_filters_and_analyzers,
+    )
+try:
+    from modules import filter_design
+except:
+    from physiology_analysis_tools.modules import filter_design
+
+
+# %% define functions
+class Settings:
+    def __init__(self):
+        # set when expiration is recorded as positive flow
+        self.flow_invert = False
+        # flow must pass +/- hysteresis x the 95th percentile of |flow| to
+        # start a new phase
+        self.hysteresis = 0.1
+        # smoothing filter, as apply_smoothing_filter()
+        self.high_pass = 0.1
+        self.high_pass_order = 2
+        self.low_pass = 50
+        self.low_pass_order = 10
+
+
+breath_columns = [
+    "index_insp",
+    "ts_insp",
+    "index_exp",
+    "ts_exp",
+    "Ti",
+    "Te",
+    "TV",
+    "frequency",
+    "MV",
+    "PIF",
+    "PEF",
+]
+
+
+def find_breaths(flow, hysteresis=0.1):
+    """
+    Locate the inspiration and expiration onsets of a smoothed flow signal
+    (inspiration positive). A phase starts at the zero crossing preceding
+    the first sample beyond +/- hysteresis x the 95th percentile of |flow|,
+    so crossings that do not reach that level are ignored.
+
+    Parameters
+    ----------
+    flow : numpy.ndarray of Floats
+        smoothed flow, inspiration positive
+    hysteresis : Float, optional
+        threshold relative to the 95th percentile of |flow|.
+        The default is 0.1.
+
+    Returns
+    -------
+    insp : numpy.ndarray of int
+        sample index of the inspiration onset of each breath
+    exp : numpy.ndarray of int
+        sample index of the expiration onset of each breath
+    next_insp : numpy.ndarray of int
+        sample index of the inspiration onset ending each breath
+    """
+    empty = numpy.zeros(0, dtype=numpy.int64)
+    if len(flow) < 2:
+        return empty, empty, empty
+    level = hysteresis * numpy.percentile(numpy.abs(flow), 95)
+
+    # phase of the samples outside the hysteresis band, and where it flips
+    outside = numpy.flatnonzero(numpy.abs(flow) > level)
+    positive = flow[outside] > 0
+    flips = numpy.flatnonzero(positive[1:] != positive[:-1]) + 1
+    insp_confirmed = outside[flips[positive[flips]]]
+    exp_confirmed = outside[flips[~positive[flips]]]
+
+    # step back to the zero crossing that began each phase
+    up = numpy.flatnonzero((flow[1:] > 0) & (flow[:-1] <= 0)) + 1
+    down = numpy.flatnonzero((flow[1:] <= 0) & (flow[:-1] > 0)) + 1
+    insp = numpy.searchsorted(up, insp_confirmed, side="right") - 1
+    exp = numpy.searchsorted(down, exp_confirmed, side="right") - 1
+    insp = up[insp[insp >= 0]]
+    exp = down[exp[exp >= 0]]
+
+    # phases alternate, so pair each inspiration with the next expiration
+    if len(insp) > 0:
+        exp = exp[exp > insp[0]]
+    n_breaths = min(len(insp) - 1, len(exp))
+    if n_breaths < 1:
+        return empty, empty, empty
+    return insp[:n_breaths], exp[:n_breaths], insp[1 : n_breaths + 1]
+
+
+def measure_breaths(flow, ts, sampling_frequency, insp, exp, next_insp):
+    """
+    Per-breath measurements from find_breaths(), using a cumulative sum for
+    the volumes and segment-wise reductions for the peak flows.
+
+    Parameters
+    ----------
+    flow : numpy.ndarray of Floats
+        smoothed flow, inspiration positive
+    ts : numpy.ndarray of Floats
+        timestamps paired to flow
+    sampling_frequency : Float
+        sampling rate (Hz)
+    insp, exp, next_insp : numpy.ndarray of int
+        output of find_breaths()
+
+    Returns
+    -------
+    breath_df : pandas.DataFrame
+        one row per breath with the columns in breath_columns
+        - Ti, Te - inspiratory and expiratory time (s)
+        - TV - tidal volume, flow integrated over inspiration (flow units
+          x s, e.g. mL for mL/s)
+        - frequency - breaths per minute, from Ti + Te
+        - MV - minute ventilation, TV x frequency
+        - PIF, PEF - peak inspiratory and expiratory flow
+    """
+    ti = (exp - insp) / sampling_frequency
+    te = (next_insp - exp) / sampling_frequency
+
+    cumulative = numpy.concatenate([[0.0], numpy.cumsum(flow, dtype=float)])
+    tidal_volume = (cumulative[exp] - cumulative[insp]) / sampling_frequency
+    frequency = 60 / (ti + te)
+
+    if len(insp) > 0:
+        bounds = numpy.stack([insp, exp], axis=1).reshape(-1)
+        pif = numpy.maximum.reduceat(flow, bounds)[::2]
+        bounds = numpy.stack([exp, next_insp], axis=1).reshape(-1)
+        pef = -numpy.minimum.reduceat(flow, bounds)[::2]
+    else:
+        pif = numpy.zeros(0)
+        pef = numpy.zeros(0)
+
+    return pandas.DataFrame(
+        {
+            "index_insp": insp.astype(numpy.int64),
+            "ts_insp": ts[insp],
+            "index_exp": exp.astype(numpy.int64),
+            "ts_exp": ts[exp],
+            "Ti": ti.astype(numpy.float32),
+            "Te": te.astype(numpy.float32),
+            "TV": tidal_volume.astype(numpy.float32),
+            "frequency": frequency.astype(numpy.float32),
+            "MV": (tidal_volume * frequency).astype(numpy.float32),
+            "PIF": pif.astype(numpy.float32),
+            "PEF": pef.astype(numpy.float32),
+        },
+        columns=breath_columns,
+    )
+
+
+def breathcaller(
+    df,
+    flow_column="flow",
+    time_column="ts",
+    flow_invert=False,
+    hysteresis=0.1,
+    high_pass=0.1,
+    high_pass_order=2,
+    low_pass=50,
+    low_pass_order=10,
+):
+    """
+    Detect breaths in a flow signal.
+
+    Parameters:
+    df - pandas.DataFrame - signal data
+    flow_column - str - column of flow, inspiration positive unless
+        flow_invert is set
+    time_column - str - column of timestamps (s)
+    flow_invert - bool - set when expiration is recorded as positive flow
+    hysteresis - Float - see find_breaths()
+    high_pass, high_pass_order, low_pass, low_pass_order - smoothing filter
+        settings, as for apply_smoothing_filter()
+
+    Returns:
+    - pandas.DataFrame: one row per breath, see measure_breaths()
+    """
+    ts = df[time_column].to_numpy(dtype=float)
+    flow = df[flow_column].to_numpy(dtype=float)
+    if flow_invert:
+        flow = -flow
+    sampling_frequency = 1 / (ts[1] - ts[0])
+
+    flow = signal_filters_and_analyzers.smoothing_chain(
+        sampling_frequency,
+        high_pass=high_pass,
+        high_pass_order=high_pass_order,
+        low_pass=low_pass,
+        low_pass_order=low_pass_order,
+    ).apply(flow)
+
+    return measure_breaths(
+        flow, ts, sampling_frequency, *find_breaths(flow, hysteresis=hysteresis)
+    )
+
+
+def benchmark_breathcaller(hours=12, breath_rate=180, fs=1000):
+    """
+    Time breathcaller() on a synthetic flow trace (sinusoidal breaths with
+    noise and a slow drift) and check the breath count.
+
+    Returns
+    -------
+    results : dict
+        seconds taken, breaths expected and found, median frequency and TV
+    """
+    rng = numpy.random.default_rng(0)
+    n = int(hours * 3600 * fs)
+    ts = numpy.arange(n) / fs
+    flow = (
+        numpy.sin(2 * numpy.pi * breath_rate / 60 * ts)
+        + 0.05 * rng.standard_normal(n)
+        + 0.2 * numpy.sin(2 * numpy.pi * ts / 600)
+    )
+    df = pandas.DataFrame({"ts": ts, "flow": flow})
+    del ts, flow
+
+    breath_df, elapsed = filter_design.timed(breathcaller, df)
+    results = {
+        "samples": n,
+        "seconds": elapsed,
+        "breaths_expected": int(hours * 60 * breath_rate) - 1,
+        "breaths": len(breath_df),
+        "median_frequency": float(breath_df["frequency"].median()),
+        "median_TV": float(breath_df["TV"].median()),
+    }
+    print(results)
+    return results
+
+
+if __name__ == "__main__":
+    benchmark_breathcaller()
@@ -0,0 +1,669 @@
+# -*- coding: utf-8 -*-
+
+"""
+hrv_analysis for ECG Analysis Tool
+
+Heart rate variability metrics for consecutive (or overlapping) windows of
+a beat table. Windows are located with a binary search over the beat
+timestamps and the per-window sums come from cumulative sums, so the cost
+is O(beats + windows) however many windows a multi-day recording has.
+Spectral metrics resample the whole RR series once onto a uniform grid and
+take the Welch spectra of all windows together from a strided view.
+"""
+
+__version__ = "0.0.2"
+
+# %% import libraries
+import numpy
+import pandas
+import scipy
+
+try:
+    from modules import filter_design
+except:
+    from physiology_analysis_tools.modules import filter_design
+
+
+# %% define functions
+class Settings:
+    def __init__(self):
+        # window length and spacing (s), step None gives adjacent windows
+        self.window_duration = 60
+        self.window_step = None
+        # successive RR difference (ms) counted by pNN, 6 ms suits mice,
+        # 50 ms is the usual human pNN50
+        self.pnn_threshold = 6
+
+
+class FrequencySettings:
+    def __init__(self):
+        # window length and spacing (s), step None gives adjacent windows
+        self.window_duration = 300
+        self.window_step = None
+        # uniform grid (Hz) the RR series is interpolated onto, and the
+        # Welch segment length (s) within each window
+        self.resample_rate = 20
+        self.segment_duration = 50
+        # band limits (Hz), defaults are the usual mouse bands, use
+        # 0.04-0.15 and 0.15-0.4 with resample_rate 4 for humans
+        self.lf_low = 0.15
+        self.lf_high = 1.5
+        self.hf_low = 1.5
+        self.hf_high = 5
+
+
+def beat_series(beat_table):
+    """
+    Timestamps and RR intervals of a beat table as float64 arrays.
+
+    Parameters
+    ----------
+    beat_table : BeatTable or pandas.DataFrame
+        output of beatcaller() (or basicRR()), with ts and RR (s) columns
+
+    Returns
+    -------
+    ts : numpy.ndarray of Floats
+    rr : numpy.ndarray of Floats
+    """
+    ts = numpy.asarray(beat_table["ts"], dtype=float)
+    rr = numpy.asarray(beat_table["RR"], dtype=float)
+    return ts, rr
+
+
+def window_bounds(ts, window_duration, window_step=None, start=None, stop=None):
+    """
+    Locate the beats falling in each window (start <= ts < start +
+    window_duration).
+
+    Parameters
+    ----------
+    ts : numpy.ndarray of Floats
+        sorted beat timestamps
+    window_duration : Float
+        window length (s)
+    window_step : Float, optional
+        spacing of window starts (s). The default is None, which gives
+        adjacent windows (window_step = window_duration).
+    start : Float, optional
+        start of the first window. The default is None, which uses the
+        first beat rounded down to a multiple of window_step.
+    stop : Float, optional
+        no window starts at or after stop. The default is None, which uses
+        the last beat.
+
+    Returns
+    -------
+    window_starts : numpy.ndarray of Floats
+    lo : numpy.ndarray of int
+        index of the first beat of each window
+    hi : numpy.ndarray of int
+        index one past the last beat of each window
+    """
+    if window_step is None:
+        window_step = window_duration
+    if len(ts) == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return numpy.zeros(0), empty, empty
+    if start is None:
+        start = numpy.floor(ts[0] / window_step) * window_step
+    if stop is None:
+        stop = ts[-1] + window_step * 1e-9
+
+    window_starts = start + window_step * numpy.arange(
+        max(0, int(numpy.ceil((stop - start) / window_step)))
+    )
+    lo = numpy.searchsorted(ts, window_starts, side="left")
+    hi = numpy.searchsorted(ts, window_starts + window_duration, side="left")
+    return window_starts, lo, hi
+
+
+def window_sums(values, lo, hi):
+    """
+    Sum of values[lo:hi] for every window, from one cumulative sum.
+    """
+    cumulative = numpy.concatenate([[0.0], numpy.cumsum(values, dtype=float)])
+    return cumulative[hi] - cumulative[lo]
+
+
+def time_domain_hrv(
+    beat_table,
+    window_duration=60,
+    window_step=None,
+    pnn_threshold=6,
+    start=None,
+    stop=None,
+):
+    """
+    Windowed time domain heart rate variability.
+
+    Parameters
+    ----------
+    beat_table : BeatTable or pandas.DataFrame
+        output of beatcaller() (or basicRR()), with ts and RR (s) columns
+    window_duration : Float, optional
+        window length (s). The default is 60.
+    window_step : Float, optional
+        spacing of window starts (s). The default is None, which gives
+        adjacent windows.
+    pnn_threshold : Float, optional
+        successive RR difference (ms) counted by pNN. The default is 6.
+    start, stop : Float, optional
+        range of window starts, see window_bounds()
+
+    Returns
+    -------
+    hrv_df : pandas.DataFrame
+        indexed by window_start (s), with columns
+        - beats - number of beats in the window
+        - mean_RR - mean RR interval (ms)
+        - mean_HR - mean heart rate (bpm)
+        - SDNN - standard deviation of RR (ms)
+        - RMSSD - root mean square of successive RR differences (ms)
+        - pNN<threshold> - % of successive differences above pnn_threshold
+        - IS_RR - mean irregularity score of RR (%), as
+          calculate_irreg_score()
+        Metrics needing more beats than the window holds are NaN. Only
+        successive differences with both beats inside the window count.
+    """
+    ts, rr = beat_series(beat_table)
+    rr = rr * 1000
+    window_starts, lo, hi = window_bounds(
+        ts, window_duration, window_step=window_step, start=start, stop=stop
+    )
+
+    # successive differences pair beat k with k + 1, so a window holding
+    # beats lo..hi-1 holds differences lo..hi-2
+    differences = numpy.diff(rr)
+    lo_diff = lo
+    hi_diff = numpy.maximum(hi - 1, lo)
+
+    # centre on the overall mean before summing squares so the cumulative
+    # sums do not lose precision on multi-day recordings
+    centre = rr.mean() if len(rr) else 0.0
+    centred = rr - centre
+
+    beats = hi - lo
+    n_differences = hi_diff - lo_diff
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        rr_sum = window_sums(centred, lo, hi)
+        rr_mean = rr_sum / beats
+        rr_var = (window_sums(centred**2, lo, hi) - rr_sum * rr_mean) / (beats - 1)
+        sdnn = numpy.sqrt(numpy.maximum(rr_var, 0))
+        sdnn[beats < 2] = numpy.nan
+
+        rmssd = numpy.sqrt(
+            window_sums(differences**2, lo_diff, hi_diff) / n_differences
+        )
+        pnn = (
+            window_sums(numpy.abs(differences) > pnn_threshold, lo_diff, hi_diff)
+            / n_differences
+            * 100
+        )
+        irreg_score = (
+            window_sums(numpy.abs(differences) / rr[:-1] * 100, lo_diff, hi_diff)
+            / n_differences
+        )
+        mean_hr = window_sums(60000 / rr, lo, hi) / beats
+
+    return pandas.DataFrame(
+        {
+            "beats": beats,
+            "mean_RR": rr_mean + centre,
+            "mean_HR": mean_hr,
+            "SDNN": sdnn,
+            "RMSSD": rmssd,
+            f"pNN{pnn_threshold:g}": pnn,
+            "IS_RR": irreg_score,
+        },
+        index=pandas.Index(window_starts, name="window_start"),
+    )
+
+
+def rolling_time_domain_hrv(
+    beat_table, window_durations=(60, 300), pnn_threshold=6, **kwargs
+):
+    """
+    time_domain_hrv() for several window lengths, e.g. the 1 and 5 minute
+    windows reported for telemetry.
+
+    Parameters
+    ----------
+    beat_table : BeatTable or pandas.DataFrame
+        output of beatcaller()
+    window_durations : list of Floats, optional
+        window lengths (s). The default is (60, 300).
+    pnn_threshold : Float, optional
+        successive RR difference (ms) counted by pNN. The default is 6.
+    **kwargs :
+        passed to time_domain_hrv()
+
+    Returns
+    -------
+    hrv : dict of pandas.DataFrame
+        time_domain_hrv() output keyed by window duration
+    """
+    return {
+        window_duration: time_domain_hrv(
+            beat_table,
+            window_duration=window_duration,
+            pnn_threshold=pnn_threshold,
+            **kwargs,
+        )
+        for window_duration in window_durations
+    }
+
+
+def time_domain_hrv_reference(beat_table, window_duration=60, pnn_threshold=6):
+    """
+    Window by window version of time_domain_hrv() (adjacent windows only),
+    used to check and benchmark the vectorized version.
+    """
+    ts, rr = beat_series(beat_table)
+    rr = rr * 1000
+    window_starts, lo, hi = window_bounds(ts, window_duration)
+    rows = []
+    for window_start in window_starts:
+        window_rr = rr[(ts >= window_start) & (ts < window_start + window_duration)]
+        differences = numpy.diff(window_rr)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            rows.append(
+                {
+                    "beats": len(window_rr),
+                    "mean_RR": numpy.mean(window_rr) if len(window_rr) else numpy.nan,
+                    "mean_HR": (
+                        numpy.mean(60000 / window_rr) if len(window_rr) else numpy.nan
+                    ),
+                    "SDNN": (
+                        numpy.std(window_rr, ddof=1) if len(window_rr) > 1 else numpy.nan
+                    ),
+                    "RMSSD": (
+                        numpy.sqrt(numpy.mean(differences**2))
+                        if len(differences)
+                        else numpy.nan
+                    ),
+                    f"pNN{pnn_threshold:g}": (
+                        numpy.mean(numpy.abs(differences) > pnn_threshold) * 100
+                        if len(differences)
+                        else numpy.nan
+                    ),
+                    "IS_RR": (
+                        numpy.mean(numpy.abs(differences) / window_rr[:-1] * 100)
+                        if len(differences)
+                        else numpy.nan
+                    ),
+                }
+            )
+    return pandas.DataFrame(rows, index=pandas.Index(window_starts, name="window_start"))
+
+
+def benchmark_time_domain_hrv(hours=24, heart_rate=600, window_duration=60):
+    """
+    Compare time_domain_hrv() with the window by window reference on a
+    synthetic beat series.
+
+    Returns
+    -------
+    results : dict
+        seconds taken by each version and the largest difference between
+        their outputs
+    """
+    rng = numpy.random.default_rng(0)
+    n_beats = int(hours * 3600 * heart_rate / 60)
+    rr = 60 / heart_rate * (1 + 0.05 * rng.standard_normal(n_beats))
+    beat_table = pandas.DataFrame({"ts": numpy.cumsum(rr), "RR": rr})
+
+    vectorized, vectorized_time = filter_design.timed(
+        time_domain_hrv, beat_table, window_duration=window_duration
+    )
+    reference, reference_time = filter_design.timed(
+        time_domain_hrv_reference, beat_table, window_duration=window_duration
+    )
+
+    results = {
+        "beats": n_beats,
+        "windows": len(vectorized),
+        "vectorized": vectorized_time,
+        "reference": reference_time,
+        "max_difference": numpy.nanmax(numpy.abs(vectorized - reference).values),
+    }
+    print(results)
+    return results
+
+
+def resample_rr(beat_table, resample_rate=20, start=None, stop=None):
+    """
+    Interpolate the RR series (ms) linearly onto a uniform time grid. Before
+    the first and after the last beat the nearest RR is held.
+
+    Parameters
+    ----------
+    beat_table : BeatTable or pandas.DataFrame
+        output of beatcaller() (or basicRR()), with ts and RR (s) columns
+    resample_rate : Float, optional
+        rate of the uniform grid (Hz). The default is 20.
+    start, stop : Float, optional
+        range of the grid. The default is None, the first and last beat.
+
+    Returns
+    -------
+    grid_ts : numpy.ndarray of Floats
+    grid_rr : numpy.ndarray of Floats
+    """
+    ts, rr = beat_series(beat_table)
+    if start is None:
+        start = ts[0] if len(ts) else 0.0
+    if stop is None:
+        stop = ts[-1] if len(ts) else 0.0
+    grid_ts = start + numpy.arange(int((stop - start) * resample_rate) + 1) / (
+        resample_rate
+    )
+    if len(ts) == 0:
+        return grid_ts, numpy.full(len(grid_ts), numpy.nan)
+    return grid_ts, numpy.interp(grid_ts, ts, rr * 1000)
+
+
+def band_power(frequencies, psd, low, high):
+    """
+    Power between low and high (low < f <= high) by the trapezoid rule
+    along the last axis of psd.
+    """
+    mask = (frequencies > low) & (frequencies <= high)
+    return numpy.trapezoid(psd[..., mask], frequencies[mask], axis=-1)
+
+
+def segment_band_powers(data, fs, nperseg, bands, batch_size=10000):
+    """
+    Band powers of every half-overlapping, linearly detrended, Hann
+    windowed segment of data, scaled as scipy.signal.welch() (density,
+    one sided) scales each segment before averaging.
+
+    Parameters
+    ----------
+    data : numpy.ndarray of Floats
+        uniformly sampled signal
+    fs : Float
+        sampling rate (Hz)
+    nperseg : int
+        segment length (samples)
+    bands : list of (low, high)
+        band limits (Hz), see band_power()
+    batch_size : int, optional
+        segments transformed at once. The default is 10000.
+
+    Returns
+    -------
+    powers : numpy.ndarray of Floats
+        shape (segments, bands)
+    """
+    if len(data) < nperseg:
+        return numpy.empty((0, len(bands)))
+    segment_step = nperseg - nperseg // 2
+    n_segments = (len(data) - nperseg) // segment_step + 1
+    segments = numpy.lib.stride_tricks.sliding_window_view(data, nperseg)[
+        ::segment_step
+    ][:n_segments]
+
+    taper = scipy.signal.get_window("hann", nperseg)
+    scale = 1 / (fs * (taper**2).sum())
+    frequencies = scipy.fft.rfftfreq(nperseg, 1 / fs)
+    x = numpy.arange(nperseg) - (nperseg - 1) / 2
+
+    powers = numpy.empty((n_segments, len(bands)))
+    for first in range(0, n_segments, batch_size):
+        batch = segments[first : first + batch_size]
+        slope = (batch @ x) / (x @ x)
+        detrended = batch - batch.mean(axis=1, keepdims=True) - slope[:, None] * x
+        psd = numpy.abs(scipy.fft.rfft(detrended * taper, axis=1)) ** 2 * scale
+        if nperseg % 2:
+            psd[:, 1:] *= 2
+        else:
+            psd[:, 1:-1] *= 2
+        for b, (low, high) in enumerate(bands):
+            powers[first : first + len(psd), b] = band_power(frequencies, psd, low, high)
+    return powers
+
+
+def frequency_domain_hrv(
+    beat_table,
+    window_duration=300,
+    window_step=None,
+    resample_rate=20,
+    segment_duration=50,
+    lf_low=0.15,
+    lf_high=1.5,
+    hf_low=1.5,
+    hf_high=5,
+    start=None,
+    stop=None,
+    batch_size=1000,
+):
+    """
+    Windowed frequency domain heart rate variability. The RR series is
+    resampled once onto a uniform grid and every window is a row of a
+    strided view of it, so the Welch spectra of a batch of windows are
+    computed in one call.
+
+    Parameters
+    ----------
+    beat_table : BeatTable or pandas.DataFrame
+        output of beatcaller() (or basicRR()), with ts and RR (s) columns
+    window_duration : Float, optional
+        window length (s). The default is 300.
+    window_step : Float, optional
+        spacing of window starts (s). The default is None, which gives
+        adjacent windows.
+    resample_rate : Float, optional
+        rate of the uniform RR grid (Hz), at least twice hf_high.
+        The default is 20.
+    segment_duration : Float, optional
+        Welch segment length (s), 50 % overlap. The default is 50.
+    lf_low, lf_high, hf_low, hf_high : Float, optional
+        band limits (Hz). The defaults are the mouse LF (0.15-1.5) and HF
+        (1.5-5) bands.
+    start, stop : Float, optional
+        range of window starts, see window_bounds()
+    batch_size : int, optional
+        windows per Welch call, bounding memory use. The default is 1000.
+
+    Returns
+    -------
+    hrv_df : pandas.DataFrame
+        indexed by window_start (s), with columns
+        - beats - number of beats in the window
+        - LF - low frequency power (ms^2)
+        - HF - high frequency power (ms^2)
+        - LF_HF - LF / HF
+        - total_power - power up to hf_high (ms^2)
+        Only windows that fit entirely before the last beat are returned,
+        and windows without beats are NaN.
+    """
+    if window_step is None:
+        window_step = window_duration
+    ts, rr = beat_series(beat_table)
+    columns = ["beats", "LF", "HF", "LF_HF", "total_power"]
+    if len(ts) == 0:
+        return pandas.DataFrame(
+            columns=columns, index=pandas.Index([], name="window_start")
+        )
+    if start is None:
+        start = numpy.floor(ts[0] / window_step) * window_step
+    if stop is None:
+        stop = ts[-1]
+
+    grid_ts, grid_rr = resample_rr(
+        beat_table, resample_rate=resample_rate, start=start, stop=stop
+    )
+    window_samples = int(round(window_duration * resample_rate))
+    step_samples = int(round(window_step * resample_rate))
+    nperseg = min(int(round(segment_duration * resample_rate)), window_samples)
+
+    if len(grid_rr) < window_samples:
+        windows = numpy.zeros((0, window_samples))
+    else:
+        windows = numpy.lib.stride_tricks.sliding_window_view(
+            grid_rr, window_samples
+        )[::step_samples]
+    window_starts = grid_ts[0] + numpy.arange(len(windows)) * step_samples / (
+        resample_rate
+    )
+
+    bands = [(lf_low, lf_high), (hf_low, hf_high), (0, hf_high)]
+    segment_step = nperseg - nperseg // 2
+    if step_samples % segment_step == 0:
+        # windows start on the shared Welch segment grid, so each segment
+        # spectrum is computed once and band powers (linear in the
+        # spectrum) are averaged over the segments of each window
+        powers = segment_band_powers(
+            grid_rr, resample_rate, nperseg, bands, batch_size=batch_size * 10
+        )
+        segments_per_window = (window_samples - nperseg) // segment_step + 1
+        first_segment = numpy.arange(len(windows)) * (step_samples // segment_step)
+        cumulative = numpy.concatenate(
+            [numpy.zeros((1, len(bands))), numpy.cumsum(powers, axis=0)]
+        )
+        window_powers = (
+            cumulative[first_segment + segments_per_window] - cumulative[first_segment]
+        ) / segments_per_window
+    else:
+        window_powers = numpy.empty((len(windows), len(bands)))
+        for first in range(0, len(windows), batch_size):
+            frequencies, psd = scipy.signal.welch(
+                windows[first : first + batch_size],
+                fs=resample_rate,
+                nperseg=nperseg,
+                detrend="linear",
+                axis=-1,
+            )
+            for b, (low, high) in enumerate(bands):
+                window_powers[first : first + len(psd), b] = band_power(
+                    frequencies, psd, low, high
+                )
+    lf, hf, total = window_powers.T.copy()
+
+    beats = numpy.searchsorted(
+        ts, window_starts + window_duration, side="left"
+    ) - numpy.searchsorted(ts, window_starts, side="left")
+    empty = beats == 0
+    lf[empty] = numpy.nan
+    hf[empty] = numpy.nan
+    total[empty] = numpy.nan
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        lf_hf = lf / hf
+
+    return pandas.DataFrame(
+        {"beats": beats, "LF": lf, "HF": hf, "LF_HF": lf_hf, "total_power": total},
+        index=pandas.Index(window_starts, name="window_start"),
+    )
+
+
+def frequency_domain_hrv_reference(beat_table, window_duration=300, **kwargs):
+    """
+    Window by window version of frequency_domain_hrv() (adjacent windows
+    only), interpolating and taking the spectrum of each window separately.
+    Used to check and benchmark the vectorized version.
+    """
+    settings = FrequencySettings()
+    settings.__dict__.update(kwargs)
+    fs = settings.resample_rate
+    ts, rr = beat_series(beat_table)
+    window_samples = int(round(window_duration * fs))
+    start = numpy.floor(ts[0] / window_duration) * window_duration
+    rows = {}
+    window_start = start
+    while window_start + (window_samples - 1) / fs <= ts[-1]:
+        grid_ts = window_start + numpy.arange(window_samples) / fs
+        frequencies, psd = scipy.signal.welch(
+            numpy.interp(grid_ts, ts, rr * 1000),
+            fs=fs,
+            nperseg=int(round(settings.segment_duration * fs)),
+            detrend="linear",
+        )
+        lf = band_power(frequencies, psd, settings.lf_low, settings.lf_high)
+        hf = band_power(frequencies, psd, settings.hf_low, settings.hf_high)
+        rows[window_start] = {
+            "LF": lf,
+            "HF": hf,
+            "LF_HF": lf / hf,
+            "total_power": band_power(frequencies, psd, 0, settings.hf_high),
+        }
+        window_start += window_duration
+    reference_df = pandas.DataFrame.from_dict(rows, orient="index")
+    reference_df.index.name = "window_start"
+    return reference_df
+
+
+def benchmark_frequency_domain_hrv(hours=24, heart_rate=600, window_duration=300):
+    """
+    Compare frequency_domain_hrv() with the window by window reference on a
+    synthetic beat series with respiratory (2.5 Hz) and slower (0.5 Hz)
+    modulation of RR.
+
+    Returns
+    -------
+    results : dict
+        seconds taken by each version and the largest relative difference
+        between their outputs
+    """
+    rng = numpy.random.default_rng(0)
+    n_beats = int(hours * 3600 * heart_rate / 60)
+    rr = numpy.full(n_beats, 60 / heart_rate)
+    ts = numpy.cumsum(rr)
+    rr = rr * (
+        1
+        + 0.02 * numpy.sin(2 * numpy.pi * 2.5 * ts)
+        + 0.03 * numpy.sin(2 * numpy.pi * 0.5 * ts)
+        + 0.01 * rng.standard_normal(n_beats)
+    )
+    beat_table = pandas.DataFrame({"ts": numpy.cumsum(rr), "RR": rr})
+
+    # load scipy.signal and scipy.fft before timing
+    frequency_domain_hrv(beat_table[:10000], window_duration=window_duration)
+
+    vectorized, vectorized_time = filter_design.timed(
+        frequency_domain_hrv, beat_table, window_duration=window_duration
+    )
+    reference, reference_time = filter_design.timed(
+        frequency_domain_hrv_reference, beat_table, window_duration=window_duration
+    )
+
+    columns = reference.columns
+    compared = vectorized.loc[reference.index, columns]
+    results = {
+        "beats": n_beats,
+        "windows": len(vectorized),
+        "vectorized": vectorized_time,
+        "reference": reference_time,
+        "max_relative_difference": numpy.nanmax(
+            numpy.abs((compared - reference) / reference).values
+        ),
+    }
+    print(results)
+    return results
+
+
+def check_short_recordings():
+    """
+    Check that frequency_domain_hrv() gives an empty table rather than an
+    error for recordings too short for a single window or Welch segment. Raises an AssertionError if
+    they do not.
+
+    Returns
+    -------
+    n_cases : int
+        number of recordings checked
+    """
+    n_cases = 0
+    for n_beats in (0, 1, 2, 400):
+        ts = numpy.arange(n_beats) * 0.1  # 400 beats span 40 s < segment_duration
+        beat_table = pandas.DataFrame({"ts": ts, "RR": numpy.full(n_beats, 0.1)})
+        assert len(frequency_domain_hrv(beat_table)) == 0, n_beats
+        n_cases += 1
+    return n_cases
+
+
+if __name__ == "__main__":
+    check_short_recordings()
+    benchmark_time_domain_hrv()
+    benchmark_frequency_domain_hrv()
@@ -12,6 +12,13 @@ import pandas as pd
 import sklearn.decomposition
 import sklearn.cluster
 
+try:
+    from modules import heartbeat_detection
+    from modules import filter_design
+except:
+    from physiology_analysis_tools.modules import heartbeat_detection
+    from physiology_analysis_tools.modules import filter_design
+
 __version__ = "0.0.1"
 
 
@@ -19,14 +26,15 @@ def basic_filter(order, signal, fs=1000, cutoff=5, output="sos"):
     """
     Copy of heartbeat_detection.basic_filter, where inverted beats are detected automatically.
     These inverted beats will be flipped to allow for comparison across datasets.
+    The polarity is estimated from a few short windows of the filtered signal
+    with heartbeat_detection.detect_ecg_inversion.
     """
-    sos = scipy.signal.butter(order, cutoff, fs=fs, btype="highpass", output="sos")
+    sos = filter_design.butter(order, cutoff, fs=fs, btype="highpass", output="sos")
     filtered_data = scipy.signal.sosfiltfilt(sos, signal)
 
-    peaks, _ = scipy.signal.find_peaks(filtered_data, distance=100)
-    neg_peaks, _ = scipy.signal.find_peaks(-filtered_data, distance=100)
-
-    ecg_invert = abs(filtered_data[peaks].mean()) < abs(filtered_data[neg_peaks].mean())
+    ecg_invert = heartbeat_detection.detect_ecg_inversion(
+        filtered_data, fs, ecg_filter=False
+    )
 
     if ecg_invert:
         return filtered_data * -1
@@ -67,21 +75,29 @@ def beatepocher(
 
     epochs_dict = {}
 
-    for idx, ts in enumerate(beat_df.ts):
+    voltage = filtered_data_frame[voltage_column].to_numpy()
 
-        index = list(filtered_data_frame[time_column]).index(ts)
+    # sample index of each beat, taken from the "sample" column written by
+    # heartbeat_detection.BeatTable.to_frame() when available, otherwise
+    # located by timestamp with a binary search
+    if "sample" in beat_df.columns:
+        beat_index = beat_df["sample"].to_numpy()
+    elif beat_df.index.name == "sample":
+        beat_index = beat_df.index.to_numpy()
+    else:
+        beat_index = numpy.searchsorted(
+            filtered_data_frame[time_column].to_numpy(), beat_df.ts.to_numpy()
+        )
 
-        start = index - round(pre_window, 0)
-        end = index + round(post_window, 0)
+    for idx, index in enumerate(beat_index):
 
-        if (start < min(filtered_data_frame.index)) or (
-            end > max(filtered_data_frame.index)
-        ):
-            continue
+        start = int(index - round(pre_window, 0))
+        end = int(index + round(post_window, 0))
 
-        data_epoch = filtered_data_frame.loc[start:end]
+        if (start < 0) or (end > len(voltage) - 1):
+            continue
 
-        beat_epoch = data_epoch[voltage_column].to_numpy()
+        beat_epoch = voltage[start : end + 1]
 
         epochs_dict[idx] = detrend_normalise(beat_epoch)
 
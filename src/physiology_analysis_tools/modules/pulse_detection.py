@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+
+"""
+pulse_detection for ECG Analysis Tool
+
+Blood pressure pulse detection built on signal_filters_and_analyzers.
+basicPulse: systolic peaks and diastolic feet are the turning points of the
+smoothed pressure, found with array operations. Long recordings are worked
+through in blocks with bounded memory by pulsecaller_chunked().
+"""
+
+__version__ = "0.0.1"
+
+# %% import libraries
+import numpy
+import pandas
+
+try:
+    from modules.signal_converters import signal_filters_and_analyzers
+except:
+    from physiology_analysis_tools.modules.signal_converters import (
+        signal_filters_and_analyzers,
+    )
+try:
+    from modules import heartbeat_detection
+except:
+    from physiology_analysis_tools.modules import heartbeat_detection
+try:
+    from modules import filter_design
+except:
+    from physiology_analysis_tools.modules import filter_design
+
+
+# %% define functions
+class Settings:
+    def __init__(self):
+        # smoothing filter, as apply_smoothing_filter()
+        self.high_pass = 0.1
+        self.high_pass_order = 2
+        self.low_pass = 50
+        self.low_pass_order = 10
+
+
+pulse_columns = [
+    "index_dia",
+    "ts_dia",
+    "index_sys",
+    "ts_sys",
+    "systolic",
+    "diastolic",
+    "MAP",
+    "pulse_pressure",
+    "dPdt_max",
+]
+
+
+def find_pulses(pressure, filtered_pressure):
+    """
+    Locate the pulses of a pressure signal. As in basicPulse(), a systolic
+    peak is the first sample at which the smoothed pressure stops rising and
+    a diastolic foot the first sample at which it starts rising again. A
+    pulse runs from a foot, through the following peak, to the next foot, so
+    only complete cycles are returned.
+
+    Parameters
+    ----------
+    pressure : numpy.ndarray of Floats
+        pressure (mmHg), used for the reported values
+    filtered_pressure : numpy.ndarray of Floats
+        smoothed pressure, used to find the turning points and dP/dt
+
+    Returns
+    -------
+    feet : numpy.ndarray of int
+        sample index of the diastolic foot of each pulse
+    peaks : numpy.ndarray of int
+        sample index of the systolic peak of each pulse
+    next_feet : numpy.ndarray of int
+        sample index of the foot ending each pulse
+    """
+    slope = numpy.diff(filtered_pressure)
+    rising = numpy.concatenate([[False], slope > 0])
+    changing = numpy.flatnonzero(rising[1:] != rising[:-1]) + 1
+
+    # turning points alternate, so the feet and peaks interleave
+    feet = changing[rising[changing]]
+    peaks = changing[~rising[changing]]
+    if len(feet) > 0:
+        peaks = peaks[peaks > feet[0]]
+
+    n_pulses = min(len(feet) - 1, len(peaks))
+    if n_pulses < 1:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty, empty
+    return feet[:n_pulses], peaks[:n_pulses], feet[1 : n_pulses + 1]
+
+
+def measure_pulses(
+    pressure, filtered_pressure, ts, sampling_frequency, feet, peaks, next_feet
+):
+    """
+    Per-pulse measurements from find_pulses(), using segment-wise
+    reductions rather than a loop over pulses.
+
+    Parameters
+    ----------
+    pressure, filtered_pressure : numpy.ndarray of Floats
+        as for find_pulses()
+    ts : numpy.ndarray of Floats
+        timestamps paired to pressure
+    sampling_frequency : Float
+        sampling rate (Hz)
+    feet, peaks, next_feet : numpy.ndarray of int
+        output of find_pulses()
+
+    Returns
+    -------
+    pulse_df : pandas.DataFrame
+        one row per pulse with the columns in pulse_columns
+        - systolic, diastolic - pressure at the peak and foot (mmHg)
+        - MAP - mean pressure from the foot to the next foot (mmHg)
+        - pulse_pressure - systolic - diastolic (mmHg)
+        - dPdt_max - steepest rise of the smoothed pressure on the upstroke
+          (mmHg/s)
+    """
+    systolic = pressure[peaks]
+    diastolic = pressure[feet]
+
+    cumulative = numpy.concatenate([[0.0], numpy.cumsum(pressure, dtype=float)])
+    mean_pressure = (cumulative[next_feet] - cumulative[feet]) / (next_feet - feet)
+
+    # slope[k] is the rise from sample k to k + 1, the upstroke of a pulse
+    # runs from its foot to its peak
+    slope = numpy.diff(filtered_pressure) * sampling_frequency
+    if len(feet) > 0:
+        bounds = numpy.stack([feet - 1, peaks - 1], axis=1).reshape(-1)
+        dpdt_max = numpy.maximum.reduceat(slope, bounds)[::2]
+    else:
+        dpdt_max = numpy.zeros(0)
+
+    return pandas.DataFrame(
+        {
+            "index_dia": feet.astype(numpy.int64),
+            "ts_dia": ts[feet],
+            "index_sys": peaks.astype(numpy.int64),
+            "ts_sys": ts[peaks],
+            "systolic": systolic.astype(numpy.float32),
+            "diastolic": diastolic.astype(numpy.float32),
+            "MAP": mean_pressure.astype(numpy.float32),
+            "pulse_pressure": (systolic - diastolic).astype(numpy.float32),
+            "dPdt_max": dpdt_max.astype(numpy.float32),
+        },
+        columns=pulse_columns,
+    )
+
+
+def pulsecaller(
+    df,
+    pressure_column="pressure",
+    time_column="time",
+    ambient_column=None,
+    high_pass=0.1,
+    high_pass_order=2,
+    low_pass=50,
+    low_pass_order=10,
+):
+    """
+    Detect blood pressure pulses in a recording held in memory.
+
+    Parameters:
+    df - pandas.DataFrame - signal data
+    pressure_column - str - column of arterial pressure (mmHg)
+    time_column - str - column of timestamps (s)
+    ambient_column - str - optional column of ambient pressure, subtracted
+        from pressure_column as in basicPulse(). The default is None.
+    high_pass, high_pass_order, low_pass, low_pass_order - smoothing filter
+        settings, as for apply_smoothing_filter()
+
+    Returns:
+    - pandas.DataFrame: one row per pulse, see measure_pulses()
+    """
+    ts = df[time_column].to_numpy(dtype=float)
+    pressure = df[pressure_column].to_numpy(dtype=float)
+    if ambient_column is not None:
+        pressure = pressure - df[ambient_column].to_numpy(dtype=float)
+    sampling_frequency = 1 / (ts[1] - ts[0])
+
+    filtered_pressure = signal_filters_and_analyzers.smoothing_chain(
+        sampling_frequency,
+        high_pass=high_pass,
+        high_pass_order=high_pass_order,
+        low_pass=low_pass,
+        low_pass_order=low_pass_order,
+    ).apply(pressure)
+
+    return measure_pulses(
+        pressure,
+        filtered_pressure,
+        ts,
+        sampling_frequency,
+        *find_pulses(pressure, filtered_pressure),
+    )
+
+
+def pulsecaller_chunked(
+    blocks,
+    pressure_column="pressure",
+    time_column="time",
+    ambient_column=None,
+    high_pass=0.1,
+    high_pass_order=2,
+    low_pass=50,
+    low_pass_order=10,
+    overlap=None,
+):
+    """
+    Streaming version of pulsecaller that works through a recording one
+    block of samples at a time, so that memory use depends on the block size
+    rather than the length of the recording.
+
+    Each block is filtered together with `overlap` seconds of the preceding
+    and following samples (see heartbeat_detection.iterate_segments()), and
+    only pulses whose foot falls in the middle of that padded segment are
+    kept, so each pulse is reported once and the zero-phase filter edge
+    effects never reach it.
+
+    Parameters:
+    blocks - iterable of DataFrames - consecutive pieces of the recording
+        containing time_column and pressure_column (e.g. the chunks produced
+        by pandas.read_csv(..., chunksize=n) or
+        heartbeat_detection.iterate_blocks())
+    overlap - Float - seconds of context added on either side of each block,
+        which must be longer than one cardiac cycle. The default is None,
+        which uses 10 periods of the high pass cutoff (at least 10 s).
+    remaining parameters as for pulsecaller()
+
+    Returns:
+    - pandas.DataFrame: one row per pulse, see measure_pulses()
+    """
+    if overlap is None:
+        overlap = max(10 / high_pass, 10)
+
+    columns = [pressure_column]
+    if ambient_column is not None:
+        columns.append(ambient_column)
+
+    chain = None
+    pulse_tables = []
+    for segment, keep, segment_start, sampling_frequency in (
+        heartbeat_detection.iterate_segments(
+            blocks, columns, time_column=time_column, overlap=overlap
+        )
+    ):
+        if chain is None:
+            chain = signal_filters_and_analyzers.smoothing_chain(
+                sampling_frequency,
+                high_pass=high_pass,
+                high_pass_order=high_pass_order,
+                low_pass=low_pass,
+                low_pass_order=low_pass_order,
+            )
+
+        pressure = segment[pressure_column]
+        if ambient_column is not None:
+            pressure = pressure - segment[ambient_column]
+        filtered_pressure = chain.apply(pressure)
+        feet, peaks, next_feet = find_pulses(pressure, filtered_pressure)
+        kept = (feet >= keep.start) & (feet < keep.stop)
+
+        pulse_df = measure_pulses(
+            pressure,
+            filtered_pressure,
+            segment[time_column],
+            sampling_frequency,
+            feet[kept],
+            peaks[kept],
+            next_feet[kept],
+        )
+        pulse_df["index_dia"] += segment_start
+        pulse_df["index_sys"] += segment_start
+        pulse_tables.append(pulse_df)
+
+    if len(pulse_tables) == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return measure_pulses(
+            numpy.zeros(0), numpy.zeros(0), numpy.zeros(0), 1, empty, empty, empty
+        )
+    return pandas.concat(pulse_tables, ignore_index=True)
+
+
+def benchmark_pulsecaller(hours=1, heart_rate=600, fs=1000, block_size=1_000_000):
+    """
+    Compare pulsecaller() and pulsecaller_chunked() on a synthetic arterial
+    pressure trace.
+
+    Returns
+    -------
+    results : dict
+        seconds taken, pulses found by each and the largest difference
+        between their measurements
+    """
+    rng = numpy.random.default_rng(0)
+    n = int(hours * 3600 * fs)
+    ts = numpy.arange(n) / fs
+    phase = (ts * heart_rate / 60) % 1
+    pressure = (
+        80
+        + 40 * numpy.where(phase < 0.3, numpy.sin(numpy.pi * phase / 0.6), 0)
+        + 40 * numpy.where(phase >= 0.3, numpy.exp(-(phase - 0.3) * 4), 0)
+        + 0.2 * rng.standard_normal(n)
+    )
+    df = pandas.DataFrame({"time": ts, "pressure": pressure})
+
+    whole, whole_time = filter_design.timed(pulsecaller, df)
+    chunked, chunked_time = filter_design.timed(
+        pulsecaller_chunked, heartbeat_detection.iterate_blocks(df, block_size)
+    )
+
+    results = {
+        "samples": n,
+        "pulsecaller": whole_time,
+        "pulsecaller_chunked": chunked_time,
+        "pulses": len(whole),
+        "pulses_chunked": len(chunked),
+    }
+    if len(whole) == len(chunked):
+        results["max_difference"] = numpy.abs(
+            whole[pulse_columns].to_numpy(dtype=float)
+            - chunked[pulse_columns].to_numpy(dtype=float)
+        ).max()
+    print(results)
+    return results
+
+
+if __name__ == "__main__":
+    benchmark_pulsecaller()
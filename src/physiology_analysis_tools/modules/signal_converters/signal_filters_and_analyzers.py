@@ -8,12 +8,266 @@ signal filters and analyzers
 __version__ = '0.0.1'
 
 # %% import libraries
+import fractions
 import pandas
 from scipy import signal
 import numpy
 
+try:
+    from modules import filter_design
+except:
+    from physiology_analysis_tools.modules import filter_design
+
 
 # %% define functions
+class ResampleSettings:
+    def __init__(self):
+        # target sampling rate (Hz) applied after extraction, None keeps the
+        # recorded rate
+        self.resample_rate = None
+
+
+def resample_signals(
+    signal_data,
+    target_rate,
+    time_column=None,
+    comment_column="comment",
+    max_denominator=1000,
+):
+    """
+    Resample every signal column of an extracted recording to target_rate
+    with scipy.signal.resample_poly, which applies an anti-aliasing FIR as
+    part of the polyphase resampling. Intended to run directly on the output
+    of any signal_converters SASSI_extract(), so that filtering, peak
+    search, epoching and plotting all work on fewer samples.
+
+    Parameters
+    ----------
+    signal_data : pandas.DataFrame
+        extracted recording with a time column
+    target_rate : Float
+        sampling rate (Hz) to resample to. The ratio to the current rate is
+        approximated by a fraction with a denominator of at most
+        max_denominator.
+    time_column : 'String', optional
+        name of the time column. The default is None, which uses the first
+        of 'time' or 'ts' found in signal_data.
+    comment_column : 'String', optional
+        name of the comment column. Each comment is moved to the nearest
+        resampled time point (comments landing on the same point are joined
+        with '|'). The default is 'comment'.
+    max_denominator : int, optional
+        limit on the resampling factors. The default is 1000.
+
+    Returns
+    -------
+    resampled_data : pandas.DataFrame
+        recording at the new rate with the same columns. Numeric columns are
+        resampled, other columns (e.g. dates) take the value of the nearest
+        original sample.
+
+    """
+    if time_column is None:
+        time_column = [c for c in ["time", "ts"] if c in signal_data.columns][0]
+
+    time = signal_data[time_column].to_numpy(dtype=float)
+    sampleHz = 1 / (time[1] - time[0])
+
+    ratio = fractions.Fraction(target_rate / sampleHz).limit_denominator(
+        max_denominator
+    )
+    up, down = ratio.numerator, ratio.denominator
+    if up == down:
+        return signal_data
+
+    new_rate = sampleHz * up / down
+    n_samples = -(-len(time) * up // down)
+    new_time = time[0] + numpy.arange(n_samples) / new_rate
+    print(f"resampling from {sampleHz} Hz to {new_rate} Hz (x{up}/{down})")
+
+    signal_columns = [
+        c
+        for c in signal_data.columns
+        if c != time_column
+        and c != comment_column
+        and pandas.api.types.is_numeric_dtype(signal_data[c])
+        and not pandas.api.types.is_bool_dtype(signal_data[c])
+    ]
+
+    resampled_data = pandas.DataFrame({time_column: new_time})
+
+    if signal_columns:
+        resampled = signal.resample_poly(
+            signal_data[signal_columns].to_numpy(dtype=float), up, down, axis=0
+        )
+        for i, c in enumerate(signal_columns):
+            resampled_data[c] = resampled[:n_samples, i]
+
+    # nearest original sample for each new sample
+    nearest = numpy.minimum(
+        numpy.round(numpy.arange(n_samples) * down / up).astype(int), len(time) - 1
+    )
+    for c in signal_data.columns:
+        if c == time_column or c in signal_columns:
+            continue
+        if c == comment_column:
+            resampled_data[c] = resample_comments(
+                signal_data[c], time, new_time, new_rate
+            )
+        else:
+            resampled_data[c] = signal_data[c].to_numpy()[nearest]
+
+    return resampled_data[list(signal_data.columns)]
+
+
+def resample_comments(comments, time, new_time, new_rate):
+    """
+    Move comments to the nearest point of a new time base. Used by
+    resample_signals().
+
+    Parameters
+    ----------
+    comments : pandas.Series
+        comment text paired to time, blank ('' or NaN) where there is none
+    time : numpy.ndarray
+        original timestamps
+    new_time : numpy.ndarray
+        resampled timestamps, evenly spaced at new_rate
+    new_rate : Float
+        sampling rate of new_time
+
+    Returns
+    -------
+    new_comments : numpy.ndarray
+        comment text paired to new_time
+    """
+    blank = numpy.nan if comments.isna().any() else ""
+    new_comments = numpy.full(len(new_time), blank, dtype=object)
+
+    has_comment = comments.notna().to_numpy() & (comments.astype(str) != "").to_numpy()
+    positions = numpy.clip(
+        numpy.round((time[has_comment] - new_time[0]) * new_rate).astype(int),
+        0,
+        len(new_time) - 1,
+    )
+    for position, text in zip(positions, comments[has_comment]):
+        if isinstance(new_comments[position], str) and new_comments[position] != "":
+            new_comments[position] += f"|{text}"
+        else:
+            new_comments[position] = text
+
+    return new_comments
+
+
+class FilterChain:
+    """
+    A sequence of notch, high-pass, low-pass and band-stop stages compiled
+    into a single stacked second-order-sections (SOS) matrix, so the whole
+    chain is applied with one zero-phase scipy.signal.sosfiltfilt pass.
+    SOS form keeps high order filters (e.g. the order 10 Bessel low-pass)
+    numerically stable.
+
+    Stages are added with the add_* methods, which return the chain so
+    they can be strung together:
+
+        chain = FilterChain(1000).add_notch(60, 30).add_highpass(1, order=1)
+        filtered = chain.apply(signal)
+
+    Parameters
+    ----------
+    sampleHz : Float
+        the sampling rate of the data the chain will be applied to
+    """
+
+    def __init__(self, sampleHz):
+        self.sampleHz = sampleHz
+        self.stages = []
+        self._sos = None
+
+    def __repr__(self):
+        return f"FilterChain({self.sampleHz}, stages={self.stages})"
+
+    def add_stage(self, filter_type, cutoff, order=None, btype=None, Q=None):
+        """
+        Add a stage designed with filter_design.design_filter().
+
+        Returns
+        -------
+        self : FilterChain
+        """
+        self.stages.append(
+            {
+                "filter_type": filter_type,
+                "cutoff": cutoff,
+                "order": order,
+                "btype": btype,
+                "Q": Q,
+            }
+        )
+        self._sos = None
+        return self
+
+    def add_notch(self, f0, Q):
+        """
+        Add a notch stage removing f0 (Hz), with quality factor Q.
+        """
+        return self.add_stage("notch", f0, Q=Q)
+
+    def add_highpass(self, cutoff, order=2, family="butter"):
+        """
+        Add a high-pass stage, family is "butter" or "bessel".
+        """
+        return self.add_stage(family, cutoff, order=order, btype="highpass")
+
+    def add_lowpass(self, cutoff, order=2, family="butter"):
+        """
+        Add a low-pass stage, family is "butter" or "bessel".
+        """
+        return self.add_stage(family, cutoff, order=order, btype="lowpass")
+
+    def add_bandstop(self, low, high, order=2, family="butter"):
+        """
+        Add a band-stop stage removing low to high (Hz).
+        """
+        return self.add_stage(family, [low, high], order=order, btype="bandstop")
+
+    @property
+    def sos(self):
+        """
+        The stacked SOS matrix of all stages, compiled on first use.
+        """
+        if self._sos is None:
+            if len(self.stages) == 0:
+                raise ValueError("FilterChain has no stages")
+            self._sos = numpy.vstack(
+                [
+                    filter_design.design_filter(
+                        fs=self.sampleHz, output="sos", **stage
+                    )
+                    for stage in self.stages
+                ]
+            )
+        return self._sos
+
+    def apply(self, data, axis=-1):
+        """
+        Apply the chain with a single zero-phase pass.
+
+        Parameters
+        ----------
+        data : list, numpy.ndarray or pandas.Series
+            values to filter
+        axis : int, optional
+            axis of data to filter along. The default is -1.
+
+        Returns
+        -------
+        filtered : numpy.ndarray
+            the filtered data
+        """
+        return signal.sosfiltfilt(self.sos, data, axis=axis)
+
+
 def basicFilt(CT, sampleHz, f0, Q):
     """
     Applies a notch and butter filter to data, useful for reducing artifacts
@@ -40,13 +294,28 @@ def basicFilt(CT, sampleHz, f0, Q):
 
     """
 
-    b, a = signal.iirnotch(f0 / (sampleHz / 2), Q)
+    chain = FilterChain(sampleHz).add_notch(f0, Q).add_highpass(1, order=1)
+    filtered = chain.apply(CT)
+    return filtered
 
-    notched = signal.filtfilt(b, a, CT)
 
-    b, a = signal.butter(1, 1 / (sampleHz / 2), btype="highpass")
-    filtered = signal.filtfilt(b, a, notched)
-    return filtered
+def smoothing_chain(
+    sampleHz, high_pass=0.1, high_pass_order=2, low_pass=50, low_pass_order=10
+):
+    """
+    The Butterworth highpass and Bessel lowpass FilterChain applied by
+    apply_smoothing_filter(), for callers working on arrays rather than
+    DataFrames. Parameters are as for apply_smoothing_filter().
+
+    Returns
+    -------
+    chain : FilterChain
+    """
+    return (
+        FilterChain(round(sampleHz))
+        .add_highpass(high_pass, order=high_pass_order)
+        .add_lowpass(low_pass, order=low_pass_order, family="bessel")
+    )
 
 
 def apply_smoothing_filter(
@@ -87,17 +356,15 @@ def apply_smoothing_filter(
         1 / (list(signal_data["ts"])[2] - list(signal_data["ts"])[1])
     )
 
-    hpf_b, hpf_a = signal.butter(
-        high_pass_order, high_pass / (sampleHz / 2), "high"
+    chain = smoothing_chain(
+        sampleHz,
+        high_pass=high_pass,
+        high_pass_order=high_pass_order,
+        low_pass=low_pass,
+        low_pass_order=low_pass_order,
     )
 
-    hpf_signal = signal.filtfilt(hpf_b, hpf_a, signal_data[column])
-
-    lpf_b, lpf_a = signal.bessel(
-        low_pass_order, low_pass / (sampleHz / 2), "low"
-    )
-
-    lpf_hpf_signal = signal.filtfilt(lpf_b, lpf_a, hpf_signal)
+    lpf_hpf_signal = chain.apply(signal_data[column])
 
     return lpf_hpf_signal
 
@@ -182,13 +449,141 @@ def basicPulse(animal_pressure, ambient_pressure, ts, threshold=100):
 
         pulse_df[['index_sys','ts_sys','systolic']] = pulse_list_systole[['index','ts','pressure']].iloc[:pulse_list_length]
         pulse_df[['index_dia','ts_dia','diastolic']] = pulse_list_diastole[['index','ts','pressure']].iloc[1:pulse_list_length+1].reset_index(drop = True)
-        pulse_df['mean'] = pulse_df['diastolic']+(pulse_df['systolic']-pulse_df['diastolic'])/3
-        
+
+    pulse_df['mean'] = pulse_df['diastolic']+(pulse_df['systolic']-pulse_df['diastolic'])/3
+
     return pressure_df, pulse_df
     
     # %%
 
 
+def find_rr_beats_reference(CT, TS, thresh, minRR):
+    """
+    Sample by sample beat search used by basicRR(method='reference'). Kept
+    as the reference that find_rr_beats() is checked against.
+
+    Parameters
+    ----------
+    CT : Pandas.DataSeries or List of Floats
+        Series of (filtered) voltage data
+    TS : Pandas.DataSeries or List of Floats
+        Series of timestamps paired to voltage data
+    thresh : Float
+        detection threshold
+    minRR : Float
+        minimum duration of heartbeat to be considered a valid beat
+
+    Returns
+    -------
+    beats : dict or None
+        {ts: {'RR': RR, 'first': bool}}, None if the signal never crosses
+        the threshold
+
+    """
+    beats = {}
+    index_crosses = []
+    for i in range(len(CT) - 1):
+        if CT[i + 1] >= thresh and CT[i] < thresh:
+            index_crosses.append(i + 1)
+
+    if len(index_crosses) == 0:
+
+        return None
+
+    prevJ = 0
+
+    for i in index_crosses[:-1]:
+        maxR = CT[i]
+
+        TS_R = TS[i]
+        for j in range(i, len(CT), 1):
+            if CT[j] < thresh:
+                break
+            if j >= index_crosses[-1]:
+                break
+            elif CT[j] > maxR:
+                maxR = CT[j]
+
+        if j - prevJ >= minRR:
+            beats[TS_R] = {"RR": TS[j] - TS[prevJ]}
+            if prevJ == 0:
+                beats[TS_R]["first"] = True
+            else:
+                beats[TS_R]["first"] = False
+            prevJ = j
+
+    return beats
+
+
+def find_rr_beats(CT, TS, thresh, minRR):
+    """
+    Vectorized equivalent of find_rr_beats_reference(). Each beat starts at
+    an upward threshold crossing and ends at the first sample that falls
+    back below the threshold, so both ends are found with array comparisons
+    and a searchsorted instead of walking every sample.
+
+    Parameters
+    ----------
+    CT : Pandas.DataSeries or List of Floats
+        Series of (filtered) voltage data
+    TS : Pandas.DataSeries or List of Floats
+        Series of timestamps paired to voltage data
+    thresh : Float
+        detection threshold
+    minRR : Float
+        minimum duration of heartbeat to be considered a valid beat
+
+    Returns
+    -------
+    beat_df : Pandas.DataFrame or None
+        DataFrame with ts, RR and first, None if the signal never crosses
+        the threshold
+
+    """
+    CT = numpy.asarray(CT)
+    TS = numpy.asarray(TS)
+
+    above = CT >= thresh
+    index_crosses = numpy.flatnonzero(above[1:] & ~above[:-1]) + 1
+
+    if len(index_crosses) == 0:
+        return None
+
+    # the end of each beat is the first sample back below threshold, capped
+    # at the last crossing (which is never called as a beat itself)
+    starts = index_crosses[:-1]
+    below = numpy.flatnonzero(~above)
+    ends = below[numpy.minimum(numpy.searchsorted(below, starts), len(below) - 1)]
+    ends = numpy.minimum(ends, index_crosses[-1])
+
+    # ends are strictly increasing, so every beat is kept unless minRR spans
+    # more than one sample, in which case each beat depends on the last one
+    # kept
+    if minRR <= 1:
+        keep = ends >= minRR
+        keep[1:] = True
+    else:
+        keep = numpy.zeros(len(ends), dtype=bool)
+        prevJ = 0
+        for k, j in enumerate(ends.tolist()):
+            if j - prevJ >= minRR:
+                keep[k] = True
+                prevJ = j
+
+    starts = starts[keep]
+    ends = ends[keep]
+    previous_ends = numpy.concatenate([[0], ends[:-1]])
+
+    # match the object columns produced by the reference dict of dicts
+    return pandas.DataFrame(
+        {
+            "ts": TS[starts],
+            "RR": (TS[ends] - TS[previous_ends]).astype(object),
+            "first": (previous_ends == 0).astype(object),
+        }
+    )
+
+
 def basicRR(
     CT,
     TS,
@@ -199,6 +594,7 @@ def basicRR(
     ecg_filter="1",
     ecg_invert="0",
     analysis_parameters=None,
+    method="vectorized",
 ):
     """
     A simple RR based heart beat caller based on relative signal to noise
@@ -227,6 +623,10 @@ def basicRR(
         1 = on, 0 = off for inversion of ecg signal.
     analysis_parameters : dict, optional
         dictionary which may contain settings to overide defaults
+    method : Str ('vectorized' or 'reference'), optional
+        'vectorized' finds the beats with array operations, 'reference' uses
+        the original sample by sample loop. Both give the same output.
+        The default is 'vectorized'.
 
     Returns
     -------
@@ -256,45 +656,97 @@ def basicRR(
     # get above thresh
     noise_level = numpy.percentile(CT, noisecutoff)
     thresh = max(noise_level * threshfactor, absthresh)
-    beats = {}
-    index_crosses = []
-    for i in range(len(CT) - 1):
-        if CT[i + 1] >= thresh and CT[i] < thresh:
-            index_crosses.append(i + 1)
-
-    if len(index_crosses) == 0:
-
-        return beats  # pass no beats
-
-    prevJ = 0
 
-    for i in index_crosses[:-1]:
-        maxR = CT[i]
-
-        TS_R = TS[i]
-        for j in range(i, len(CT), 1):
-            if CT[j] < thresh:
-                break
-            if j >= index_crosses[-1]:
-                break
-            elif CT[j] > maxR:
-                maxR = CT[j]
+    if method == "reference":
+        beats = find_rr_beats_reference(CT, TS, thresh, minRR)
+    elif method == "vectorized":
+        beats = find_rr_beats(CT, TS, thresh, minRR)
+    else:
+        raise ValueError(f"unknown basicRR method: {method}")
 
-        if j - prevJ >= minRR:
-            beats[TS_R] = {"RR": TS[j] - TS[prevJ]}
-            if prevJ == 0:
-                beats[TS_R]["first"] = True
-            else:
-                beats[TS_R]["first"] = False
-            prevJ = j
+    if beats is None:
+        return {}  # pass no beats
 
-    if not beats:
+    if len(beats) == 0:
         return pandas.DataFrame({"ts": [], "RR": []})
 
-    beat_df = pandas.DataFrame(beats).transpose()
-    beat_df.index.name = "ts"
-    beat_df = beat_df.reset_index()
+    if isinstance(beats, dict):
+        beat_df = pandas.DataFrame(beats).transpose()
+        beat_df.index.name = "ts"
+        beat_df = beat_df.reset_index()
+    else:
+        beat_df = beats
     beat_df["HR"] = 60 / beat_df["RR"]
     beat_df["IS_RR"] = calculate_irreg_score(beat_df["RR"])
     beat_df["IS_HR"] = calculate_irreg_score(beat_df["HR"])
     return beat_df
+
+
+def check_rr_beats(seed=0):
+    """
+    Check that basicRR(method='vectorized') gives the same output as
+    basicRR(method='reference') on synthetic ECG traces covering the cases
+    the beat search has to handle: a gap with no threshold crossings, beats
+    at the start and end of the trace, beats closer than minRR and a trace
+    with no beats. Raises an AssertionError on the first difference.
+
+    Returns
+    -------
+    n_cases : int
+        number of comparisons made
+    """
+    rng = numpy.random.default_rng(seed)
+    fs = 1000
+    ts = pandas.Series(numpy.arange(20 * fs) / fs)
+
+    # 600 bpm pulse train with jittered beat times and amplitudes
+    beat_samples = numpy.cumsum(rng.normal(100, 5, 250)).astype(int)
+    beat_samples = beat_samples[beat_samples < len(ts) - 10]
+    pulse = numpy.zeros(len(ts))
+    for i, amplitude in zip(beat_samples, rng.uniform(0.8, 1.2, len(beat_samples))):
+        pulse[i - 5 : i + 6] += amplitude * numpy.hanning(11)
+    noise = 0.02 * rng.standard_normal(len(ts))
+
+    gap = pulse.copy()
+    gap[5 * fs : 8 * fs] = 0
+    edges = pulse.copy()
+    edges[:3] = 1  # starts above threshold
+    edges[-3:] = 1  # ends above threshold
+    doubled = pulse + numpy.roll(pulse, 30)  # beats closer than minRR
+
+    traces = {
+        "pulse": pulse + noise,
+        "gap": gap + noise,
+        "edges": edges + noise,
+        "doubled": doubled + noise,
+        "flat": noise,
+    }
+    settings = [
+        dict(ecg_filter="0"),
+        dict(ecg_filter="1"),
+        dict(ecg_filter="0", ecg_invert="1", absthresh=-0.5),
+        dict(ecg_filter="0", minRR=50),
+        dict(ecg_filter="0", minRR=0),
+        dict(ecg_filter="0", absthresh=5),
+    ]
+
+    n_cases = 0
+    for name, trace in traces.items():
+        CT = pandas.Series(trace)
+        for kwargs in settings:
+            reference = basicRR(CT, ts, method="reference", **kwargs)
+            vectorized = basicRR(CT, ts, method="vectorized", **kwargs)
+            if isinstance(reference, dict):
+                assert vectorized == reference, (name, kwargs)
+            else:
+                pandas.testing.assert_frame_equal(
+                    vectorized, reference, obj=f"basicRR {name} {kwargs}"
+                )
+            n_cases += 1
+
+    print(f"find_rr_beats matches find_rr_beats_reference in {n_cases} cases")
+    return n_cases
+
+
+if __name__ == "__main__":
+    check_rr_beats()
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+"""
+signal_quality for ECG Analysis Tool
+
+Signal quality indices (SQIs) for consecutive windows of an ECG recording,
+used for Quality Scoring in the GUI and to let the detectors skip spans of
+poor signal. Windows are rows of a reshaped block of the signal, so each
+index is computed for a whole block of windows at once.
+"""
+
+__version__ = "0.0.1"
+
+# %% import libraries
+import numpy
+import pandas
+
+try:
+    from modules import heartbeat_detection
+except:
+    from physiology_analysis_tools.modules import heartbeat_detection
+try:
+    from modules import spectral_analysis
+except:
+    from physiology_analysis_tools.modules import spectral_analysis
+
+
+# %% define functions
+class Settings:
+    def __init__(self):
+        # window length (s)
+        self.window_duration = 10
+        # QRS band (Hz) compared with the total power
+        self.qrs_low = 10
+        self.qrs_high = 100
+        # samples within saturation_tolerance x the signal range of the
+        # recording's min or max count as saturated
+        self.saturation_tolerance = 0.001
+        # runs of at least flatline_duration (ms) changing by no more than
+        # flatline_tolerance per sample count as flat
+        self.flatline_tolerance = 0.0
+        self.flatline_duration = 50
+        # beat detectors compared, and how close (ms) their beats must be
+        self.reference_engine = "threshold"
+        self.comparison_engine = "pan_tompkins"
+        self.agreement_tolerance = 20
+        # limits for an acceptable window
+        self.min_kurtosis = 4.0
+        self.min_qrs_power_ratio = 0.5
+        self.max_saturation = 0.01
+        self.max_flatline = 0.05
+        self.min_agreement = 0.8
+        # exclude unacceptable windows from beat and arrhythmia detection,
+        # off by default as the limits above are only a starting point
+        self.skip_low_quality = False
+
+
+quality_columns = [
+    "kurtosis",
+    "qrs_power_ratio",
+    "saturation",
+    "flatline",
+    "agreement",
+    "quality_score",
+    "acceptable",
+]
+
+
+def flatline_mask(voltage, tolerance=0.0, min_samples=50):
+    """
+    Mark the samples belonging to runs of at least min_samples samples over
+    which the signal changes by no more than tolerance per sample.
+
+    Returns
+    -------
+    mask : numpy.ndarray of bool
+        True for flat samples, paired to voltage
+    """
+    still = numpy.abs(numpy.diff(voltage)) <= tolerance
+    edges = numpy.diff(still.astype(numpy.int8), prepend=0, append=0)
+    starts = numpy.flatnonzero(edges == 1)
+    stops = numpy.flatnonzero(edges == -1) + 1  # runs of n steps span n + 1 samples
+    long_runs = stops - starts >= min_samples
+
+    marks = numpy.zeros(len(voltage) + 1, dtype=numpy.int8)
+    numpy.add.at(marks, starts[long_runs], 1)
+    numpy.add.at(marks, stops[long_runs], -1)
+    return numpy.cumsum(marks[:-1], dtype=numpy.int8) > 0
+
+
+def window_kurtosis(windows):
+    """
+    Pearson kurtosis (3 for Gaussian noise) of every row of windows. A clean
+    ECG is dominated by sharp QRS complexes and scores well above 3. Flat
+    rows are NaN.
+    """
+    centred = windows - windows.mean(axis=1, keepdims=True)
+    squared = centred**2
+    m2 = squared.mean(axis=1)
+    m4 = (squared**2).mean(axis=1)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return m4 / m2**2
+
+
+def detector_agreement(ts_a, ts_b, window_starts, window_duration, tolerance):
+    """
+    Agreement between two beat detectors in each window, as matched beats /
+    (beats_a + beats_b - matched). A beat of a is matched when b has a beat
+    within tolerance of it.
+
+    Parameters
+    ----------
+    ts_a, ts_b : numpy.ndarray of Floats
+        sorted beat timestamps from each detector
+    window_starts : numpy.ndarray of Floats
+        evenly spaced window starts
+    window_duration : Float
+        window length (s)
+    tolerance : Float
+        largest time difference (s) counted as the same beat
+
+    Returns
+    -------
+    agreement : numpy.ndarray of Floats
+        0 to 1 per window, NaN where neither detector found a beat
+    """
+    n_windows = len(window_starts)
+    if n_windows == 0:
+        return numpy.zeros(0)
+
+    matched = numpy.zeros(len(ts_a), dtype=bool)
+    if len(ts_b) > 0:
+        position = numpy.searchsorted(ts_b, ts_a)
+        before = ts_b[numpy.maximum(position - 1, 0)]
+        after = ts_b[numpy.minimum(position, len(ts_b) - 1)]
+        matched = (
+            numpy.minimum(numpy.abs(ts_a - before), numpy.abs(after - ts_a))
+            <= tolerance
+        )
+
+    def count(ts, weights=None):
+        window = numpy.floor((ts - window_starts[0]) / window_duration).astype(int)
+        inside = (window >= 0) & (window < n_windows)
+        return numpy.bincount(
+            window[inside],
+            weights=None if weights is None else weights[inside],
+            minlength=n_windows,
+        )
+
+    n_matched = count(ts_a, matched.astype(float))
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return n_matched / (count(ts_a) + count(ts_b) - n_matched)
+
+
+def signal_quality(
+    df,
+    voltage_column="ecg",
+    time_column="time",
+    settings=None,
+    beat_tables=None,
+    beat_settings=None,
+    block_windows=360,
+):
+    """
+    Per-window signal quality indices of an ECG recording.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        signal data
+    voltage_column : str, optional
+        name of the ecg column. The default is "ecg".
+    time_column : str, optional
+        name of the time column. The default is "time".
+    settings : Settings, optional
+        The default is None, which uses Settings().
+    beat_tables : list of two BeatTables or DataFrames, optional
+        beats from two detectors to compare. The default is None, which runs
+        settings.reference_engine and settings.comparison_engine.
+    beat_settings : dict, optional
+        {engine: settings object} used when running the detectors, e.g. the
+        GUI's tuned beat settings. The default is None, which uses each
+        engine's default settings.
+    block_windows : int, optional
+        windows processed at once, bounding the memory used. The default is
+        360.
+
+    Returns
+    -------
+    quality_df : pandas.DataFrame
+        indexed by window_start (s), with columns
+        - kurtosis - Pearson kurtosis of the window
+        - qrs_power_ratio - power in the QRS band / total power
+        - saturation - fraction of samples at the recording's min or max
+        - flatline - fraction of samples in flat runs
+        - agreement - beat detector agreement, see detector_agreement()
+        - quality_score - fraction of the above within their limits
+        - acceptable - True when all of them are
+        A trailing partial window is dropped.
+    """
+    if settings is None:
+        settings = Settings()
+
+    ts = df[time_column].to_numpy(dtype=float)
+    voltage = df[voltage_column].to_numpy(dtype=float)
+    sampling_frequency = 1 / (ts[1] - ts[0])
+    window_samples = int(round(settings.window_duration * sampling_frequency))
+    n_windows = len(voltage) // window_samples
+    window_starts = ts[: n_windows * window_samples : window_samples]
+
+    low = voltage.min()
+    high = voltage.max()
+    rail = settings.saturation_tolerance * (high - low)
+    flat = flatline_mask(
+        voltage,
+        tolerance=settings.flatline_tolerance,
+        min_samples=int(settings.flatline_duration / 1000 * sampling_frequency),
+    )
+
+    nperseg = min(window_samples, int(round(2 * sampling_frequency)))
+    bands = {
+        "qrs": (settings.qrs_low, settings.qrs_high),
+        "total": (0, sampling_frequency / 2),
+    }
+
+    kurtosis = numpy.empty(n_windows)
+    qrs_power_ratio = numpy.empty(n_windows)
+    saturation = numpy.empty(n_windows)
+    flatline = numpy.empty(n_windows)
+    for first in range(0, n_windows, block_windows):
+        last = min(first + block_windows, n_windows)
+        samples = slice(first * window_samples, last * window_samples)
+        windows = voltage[samples].reshape(-1, window_samples)
+
+        kurtosis[first:last] = window_kurtosis(windows)
+        powers = spectral_analysis.epoch_band_powers(
+            windows, sampling_frequency, nperseg, bands=bands
+        )
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            qrs_power_ratio[first:last] = powers["qrs"] / powers["total"]
+        saturation[first:last] = (
+            (windows <= low + rail) | (windows >= high - rail)
+        ).mean(axis=1)
+        flatline[first:last] = (
+            flat[samples].reshape(-1, window_samples).mean(axis=1)
+        )
+
+    if beat_tables is None:
+        if beat_settings is None:
+            beat_settings = {}
+        beat_tables = [
+            heartbeat_detection.detect_beats(
+                df,
+                voltage_column=voltage_column,
+                time_column=time_column,
+                engine=engine,
+                settings=beat_settings.get(engine),
+            )
+            for engine in (settings.reference_engine, settings.comparison_engine)
+        ]
+    agreement = detector_agreement(
+        numpy.asarray(beat_tables[0]["ts"], dtype=float),
+        numpy.asarray(beat_tables[1]["ts"], dtype=float),
+        window_starts,
+        settings.window_duration,
+        settings.agreement_tolerance / 1000,
+    )
+
+    # NaN (flat or beatless windows) fails every comparison
+    checks = numpy.stack(
+        [
+            kurtosis >= settings.min_kurtosis,
+            qrs_power_ratio >= settings.min_qrs_power_ratio,
+            saturation <= settings.max_saturation,
+            flatline <= settings.max_flatline,
+            agreement >= settings.min_agreement,
+        ]
+    )
+
+    quality_df = pandas.DataFrame(
+        {
+            "kurtosis": kurtosis,
+            "qrs_power_ratio": qrs_power_ratio,
+            "saturation": saturation,
+            "flatline": flatline,
+            "agreement": agreement,
+            "quality_score": checks.mean(axis=0),
+            "acceptable": checks.all(axis=0),
+        },
+        index=pandas.Index(window_starts, name="window_start"),
+    )
+    return quality_df.astype(
+        {c: numpy.float32 for c in quality_columns if c != "acceptable"}
+    )
+
+
+def low_quality_intervals(quality_df, window_duration):
+    """
+    Merged time intervals of the windows that are not acceptable, in the
+    form of a bad_data_list, so they can be excluded with
+    heartbeat_detection.complement_intervals().
+
+    Returns
+    -------
+    intervals : list of [start, stop]
+    """
+    starts = quality_df.index[~quality_df["acceptable"].to_numpy()]
+    return heartbeat_detection.merge_intervals(
+        [[start, start + window_duration] for start in starts]
+    )